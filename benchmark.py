@@ -0,0 +1,280 @@
+# Benchmark for the flow algorithms in sort.py (and localsearch.py)
+# Generates synthetic playlists with audio features drawn from distributions
+# like spotify's, so it runs offline without any credentials, then times each
+# flow on each playlist and records its peak memory use and how good the
+# ordering is. Results are written as JSON so runs can be compared, e.g.
+#
+#     python benchmark.py --sizes 50,1000,20000 --output before.json
+#     python benchmark.py --sizes 50,1000,20000 --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+
+import clplaylistflow
+import sort
+import localsearch
+import metrics
+from playlist import Playlist
+from track import Track
+from tracktable import TrackTable
+
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+# flow algorithms to time, each with the largest playlist it is run on by
+# default (None for no limit) as some take hours on the biggest ones
+ENGINES = OrderedDict([
+    ("simple", (sort.simpleflow, None)),
+    ("fastnn", (sort.fastnnflow, None)),
+    ("fullnn", (sort.fullnnflow, 5000)),
+    ("vectornn", (sort.vectornnflow, 20000)),
+    ("kdnn", (sort.kdnnflow, 20000)),
+    ("mst", (sort.mstflow, clplaylistflow.MSTLIMIT)),
+    ("cluster", (sort.clusterflow, None)),
+    ("hilbert", (sort.hilbertflow, None)),
+    ("fastnn+refine",
+     (lambda playlist: localsearch.refine(sort.fastnnflow(playlist)), 20000)),
+    ("hilbert+refine",
+     (lambda playlist: localsearch.refine(sort.hilbertflow(playlist)), 20000)),
+])
+
+SIZES = [50, 200, 1000, 5000, 20000, 100000]
+
+def realisticfeatures(n, rng):
+    """
+        Draw audio features for n tracks from distributions shaped like
+        those of spotify's catalog, with the usual correlations (loud songs
+        are energetic, energetic songs aren't acoustic, danceable songs are
+        happier).
+
+        Returns a dict mapping feature names to arrays.
+    """
+    energy = rng.beta(3.5, 2, n)
+    danceability = rng.beta(4.5, 3, n)
+    instrumental = rng.random_sample(n) < 0.25
+    return({
+        "danceability": danceability,
+        "energy": energy,
+        "key": rng.randint(0, 12, n),
+        "loudness": np.clip(-22 + 17 * energy + rng.normal(0, 2.5, n), -60, 0),
+        "mode": (rng.random_sample(n) < 0.65).astype(int),
+        "speechiness": 0.02 + 0.98 * rng.beta(0.8, 12, n),
+        "acousticness": np.clip(rng.beta(0.7, 1.2, n) * (1.2 - energy), 0, 1),
+        "instrumentalness": np.where(instrumental, rng.beta(3, 1.2, n),
+                                     0.1 * rng.beta(0.2, 20, n)),
+        "liveness": 0.05 + 0.95 * rng.beta(1.3, 6, n),
+        "valence": np.clip(0.5 * rng.beta(2.2, 2.3, n) + 0.5 * danceability
+                           + rng.normal(0, 0.1, n), 0, 1),
+        "tempo": np.clip(rng.normal(120, 28, n), 50, 220),
+        "duration_ms": np.clip(rng.normal(215000, 50000, n), 60000,
+                               None).astype(int),
+        "time_signature": rng.choice([3, 4, 5], n, p=[0.08, 0.9, 0.02]),
+    })
+
+def uniformfeatures(n, rng):
+    """
+        Draw audio features for n tracks uniformly over their ranges.
+
+        Returns a dict mapping feature names to arrays.
+    """
+    features = realisticfeatures(n, rng)
+    for name in ("danceability", "energy", "speechiness", "acousticness",
+                 "instrumentalness", "liveness", "valence"):
+        features[name] = rng.random_sample(n)
+    features["loudness"] = rng.uniform(-60, 0, n)
+    features["mode"] = rng.randint(0, 2, n)
+    features["tempo"] = rng.uniform(50, 220, n)
+    return(features)
+
+def clusteredfeatures(n, rng, clusters=8):
+    """
+        Draw audio features for n tracks bunched around a few "genres", each
+        a realistic track, like a playlist mixing a handful of styles.
+
+        Returns a dict mapping feature names to arrays.
+    """
+    centers = realisticfeatures(clusters, rng)
+    labels = rng.randint(0, clusters, n)
+    features = {}
+    for name, values in centers.items():
+        values = values[labels]
+        if values.dtype.kind == "f":
+            spread = {"loudness": 2.0, "tempo": 8.0}.get(name, 0.06)
+            low, high = {"loudness": (-60, 0),
+                         "tempo": (50, 220)}.get(name, (0, 1))
+            values = np.clip(values + rng.normal(0, spread, n), low, high)
+        features[name] = values
+    return(features)
+
+DISTRIBUTIONS = OrderedDict([
+    ("realistic", realisticfeatures),
+    ("uniform", uniformfeatures),
+    ("clustered", clusteredfeatures),
+])
+
+def makeplaylist(n, distribution="realistic", seed=0):
+    """
+        Build a Playlist of n synthetic tracks with features drawn from one
+        of DISTRIBUTIONS.
+
+        Returns the Playlist object.
+    """
+    rng = np.random.RandomState(seed)
+    features = DISTRIBUTIONS[distribution](n, rng)
+    table = TrackTable(capacity=n)
+    table.appendcolumns(n,
+                        trackid=["synthetic{}".format(i) for i in range(n)],
+                        popularity=rng.randint(0, 101, n),
+                        **features)
+    playlist = Playlist()
+    playlist.name = "{} {}".format(distribution, n)
+    playlist.table = table
+    playlist.tracks = [Track(table, i) for i in range(n)]
+    return(playlist)
+
+def run(engine, playlist, repeat=3):
+    """
+        Time one flow algorithm on a playlist "repeat" times, then once more
+        while tracing memory (when tracemalloc is available).
+
+        Returns a dict of results for the run.
+    """
+    flow = ENGINES[engine][0]
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        ordered = flow(playlist)
+        times.append(timeit.default_timer() - start)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        flow(playlist)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = OrderedDict()
+    result["engine"] = engine
+    result["size"] = len(playlist.tracks)
+    result["seconds"] = min(times)
+    result["medianseconds"] = float(np.median(times))
+    result["peakbytes"] = peak
+    result["valid"] = (sorted(track.index for track in ordered)
+                       == list(range(len(playlist.tracks))))
+    result["quality"] = metrics.flowmetrics(ordered)
+    return(result)
+
+def environment():
+    """
+        Returns a dict describing the machine and code being benchmarked.
+    """
+    try:
+        with open(os.devnull, "w") as devnull:
+            commit = subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return({"python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")})
+
+def compare(results, baseline):
+    """
+        Print the time and total distance of each result relative to the
+        matching result (same engine, distribution and size) of an earlier
+        run.
+    """
+    old = dict(((r["engine"], r["distribution"], r["size"]), r)
+               for r in baseline["results"])
+    print("{:<14} {:<10} {:>7} {:>10} {:>10} {:>8} {:>8}".format(
+        "engine", "dist", "size", "seconds", "before", "time", "total"))
+    for r in results["results"]:
+        before = old.get((r["engine"], r["distribution"], r["size"]))
+        if before is None:
+            continue
+        print("{:<14} {:<10} {:>7} {:>10.4f} {:>10.4f} {:>7.2f}x {:>7.3f}x"
+              .format(r["engine"], r["distribution"], r["size"],
+                      r["seconds"], before["seconds"],
+                      r["seconds"] / max(before["seconds"], 1e-9),
+                      r["quality"]["total"]
+                      / max(before["quality"]["total"], 1e-9)))
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Time the flow algorithms on synthetic playlists.")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in SIZES),
+                        help="comma separated playlist sizes")
+    parser.add_argument("--engines", default=",".join(ENGINES),
+                        help="comma separated flows, from: "
+                        + ", ".join(ENGINES))
+    parser.add_argument("--distributions", default="realistic",
+                        help="comma separated feature distributions, from: "
+                        + ", ".join(DISTRIBUTIONS))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs of each flow (the fastest counts)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--all", action="store_true",
+                        help="run every flow on every size, however slow")
+    parser.add_argument("--output", help="write the JSON results here "
+                        "instead of to stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run "
+                        "to print a comparison with")
+    args = parser.parse_args(argv)
+
+    sizes = [int(n) for n in args.sizes.split(",")]
+    engines = args.engines.split(",")
+    distributions = args.distributions.split(",")
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error("unknown engine {}".format(engine))
+    for distribution in distributions:
+        if distribution not in DISTRIBUTIONS:
+            parser.error("unknown distribution {}".format(distribution))
+
+    results = OrderedDict()
+    results["environment"] = environment()
+    results["results"] = []
+    for distribution in distributions:
+        for n in sizes:
+            playlist = makeplaylist(n, distribution, args.seed)
+            for engine in engines:
+                limit = ENGINES[engine][1]
+                if limit is not None and n > limit and not args.all:
+                    continue
+                result = run(engine, playlist, args.repeat)
+                result["distribution"] = distribution
+                result["seed"] = args.seed
+                results["results"].append(result)
+                sys.stderr.write("{:<14} {:<10} {:>7} {:>10.4f}s\n".format(
+                    engine, distribution, n, result["seconds"]))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    elif not args.compare:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,53 @@
 
 import requests
+import argparse
 import json
 import random
 import string
+import sys
+import threading
 import time
+import timeit
 import traceback
 import os
-from urlparse import urlparse, parse_qs
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError: # python 3
+    from urllib.parse import urlparse, parse_qs
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from playlist import Playlist
 from track import Track
+from tracktable import TrackTable
 import sort
+import localsearch
+from flowprofiles import FlowProfile, PROFILES, NORMALIZATIONS, METRICS
+from spotifyclient import SpotifyClient
+from instrument import instruments
+
+# most requests for pages of one listing to have in flight at once
+PAGEWORKERS = 8
+
+# seconds between sending the chunks of tracks appended to a playlist at
+# once, so that they tend to reach spotify, and land, in order (see
+# appendchunks)
+WRITESTAGGER = 0.01
+
+# where the spotify web API and accounts service are, which can be pointed at
+# a stand-in like mockspotify.py for load testing
+APIURL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com")
+ACCOUNTSURL = os.environ.get("SPOTIFY_ACCOUNTS_URL",
+                             "https://accounts.spotify.com")
+
+PLAYLISTSURL = APIURL + "/v1/me/playlists"
+FEATURESURL = APIURL + "/v1/audio-features/"
+
+# playlists per page of the /v1/me/playlists endpoint (50 at most)
+PLAYLISTPAGESIZE = 50
+
+# shared by every request to the spotify API, see spotifyclient.py
+client = SpotifyClient(poolsize=2 * PAGEWORKERS)
 
 def readappkeys():
     """
@@ -56,7 +92,7 @@ def getauthenticationurl():
 
     # create URL
     r = requests.Request("GET",
-                "https://accounts.spotify.com/authorize/",
+                ACCOUNTSURL + "/authorize/",
                 params=payload)
     prepped = r.prepare()
 
@@ -67,13 +103,15 @@ def getauthenticationurl():
     else:
         return(None, None)
 
+@instruments.timed("stage_seconds", stage="requesttokens")
 def requesttokens(code):
     """ 
         Exchange authorization code for access and refresh tokens with a POST
         request to /api/token endpoint.
 
-        Returns access token and refresh token, or None,None if unable to 
-        obtain tokens.
+        Returns access token, refresh token and the number of seconds the
+        access token is valid for, or None, None, None if unable to obtain
+        tokens.
     """
     
     appid, appsecret, redirecturi = readappkeys()
@@ -85,38 +123,49 @@ def requesttokens(code):
     payload["client_id"] = appid
     payload["client_secret"] = appsecret
 
-    r = requests.post("https://accounts.spotify.com/api/token", data=payload)
-
-    response = r.json()
-
-    if "refresh_token" not in response:
-        if response["error"]:
-            print(response["error"])
-            if response["error"]["status"]:
-                if response["error"]["status"] == 429:
-                    # wait for the amount of time specified in response header
-                    time.sleep(int(r.headers["Retry-After"]) + 1)
-                    # try again
-                    return(requesttokens(code))
-                else:
-                    print('error: token request failed')
-                    print(response["error"])
-                    return(None)
-            else:
-                print('error: token request failed')
-                print(response["error"])
-                return(None)
-        else:
-            print(response["error"])
-            return(None, None)
+    response = client.post(ACCOUNTSURL + "/api/token", None,
+                           "refresh_token", data=payload)
+    if response is None:
+        print('error: token request failed')
+        return(None, None, None)
 
     refreshtoken = response["refresh_token"]
     accesstoken = response["access_token"]
     expiration = response["expires_in"]
     # print('\ntokens:\n\n{}'.format(r.json()))
 
-    return(accesstoken, refreshtoken)
+    return(accesstoken, refreshtoken, expiration)
+
+@instruments.timed("stage_seconds", stage="refreshtokens")
+def refreshtokens(refreshtoken):
+    """
+        Get a new access token with a refresh token, with a POST request to
+        the /api/token endpoint. Spotify may send a new refresh token too,
+        otherwise the old one stays valid.
 
+        Returns access token, refresh token and the number of seconds the
+        access token is valid for, or None, None, None if unable to obtain
+        a new token.
+    """
+    appid, appsecret, redirecturi = readappkeys()
+
+    payload = {}
+    payload["grant_type"] = "refresh_token"
+    payload["refresh_token"] = refreshtoken
+    payload["client_id"] = appid
+    payload["client_secret"] = appsecret
+
+    response = client.post(ACCOUNTSURL + "/api/token", None, "access_token",
+                           data=payload)
+    if response is None:
+        print('error: token refresh failed')
+        return(None, None, None)
+
+    return(response["access_token"],
+           response.get("refresh_token") or refreshtoken,
+           response["expires_in"])
+
+@instruments.timed("stage_seconds", stage="getuserid")
 def getuserid(accesstoken):
     """ 
         Get the current user's id using the /v1/me endpoint.
@@ -124,322 +173,406 @@ def getuserid(accesstoken):
         Returns user's id as a string, or None if unable to obtain id.
     """
 
-    headers = {}
-    headers["Authorization"] = "Bearer {}".format(accesstoken)
+    response = client.get(APIURL + "/v1/me", accesstoken, "id")
+    if response is None:
+        print('error: getuserid request failed')
+        return(None)
+
+    userid = response["id"]
+    # print("userid = {}".format(userid))
+    return(userid)
+
+def getpages(url, accesstoken, paramslist, key, workers=PAGEWORKERS):
+    """
+        GET a page from a spotify endpoint for each dict of parameters in
+        paramslist, with at most "workers" requests in flight at once. "key"
+        is the field a successful response has, e.g. "items".
+
+        Returns a list of responses in the same order as paramslist, or None
+        if any of the requests fails.
+    """
+    if not paramslist:
+        return([])
 
-    r = requests.get("https://api.spotify.com/v1/me", headers=headers)
-    # print('response = \n\n {} \n\n'.format(r.text))
-    # print('userid:\n\n{}'.format(r.json()))
+    def fetch(params):
+        return(client.get(url, accesstoken, key, params))
 
+    pool = ThreadPool(min(workers, len(paramslist)))
+    try:
+        responses = pool.map(fetch, paramslist)
+    finally:
+        pool.close()
+        pool.join()
 
-    response = r.json()
-    if "id" not in response:
-        if response["error"]:
-            if response["error"]["status"] == 429:
-                # wait for the amount of time specified in response header
-                time.sleep(int(r.headers["Retry-After"]) + 1)
-                # try again
-                return(getuserid(accesstoken))
+    if any(response is None for response in responses):
+        return(None)
+    return(responses)
 
-            else:
-                print(response["error"])
-                return(None)
-        else:
-            print('error: getuserid request failed')
-            return(None)
+def iterpages(url, accesstoken, limit, workers=PAGEWORKERS, params=None):
+    """
+        Generator over the pages of a paged spotify endpoint, in order. The
+        first page gives the total number of items, then the rest are all
+        requested at once (at most "workers" at a time), and each page is
+        yielded as soon as it and the pages before it have arrived, so it
+        can be used while later pages are still downloading. Any other
+        query parameters can be given as a dict in "params".
+
+        Yields the response for each page, or None (and then stops) if there
+        is an error.
+    """
+    payload = dict(params or {})
+    payload["limit"] = limit
+    payload["offset"] = 0
 
-    userid = response["id"]
-    # print("userid = {}".format(userid))
-    return(userid)
+    response = client.get(url, accesstoken, "items", payload)
+    yield response
+    if response is None:
+        return
+
+    paramslist = []
+    for offset in range(limit, response["total"], limit):
+        payload = dict(params or {})
+        payload["limit"] = limit
+        payload["offset"] = offset
+        paramslist.append(payload)
+    if not paramslist:
+        return
+
+    def fetch(params):
+        return(client.get(url, accesstoken, "items", params))
 
+    pool = ThreadPool(min(workers, len(paramslist)))
+    try:
+        for response in pool.imap(fetch, paramslist):
+            yield response
+            if response is None:
+                return
+    finally:
+        pool.terminate()
+
+@instruments.timed("stage_seconds", stage="getplaylists")
 def getplaylists(accesstoken, userid):
     """ 
         Build a dict containing the names, thumbnail URLs, and playlist IDs of
         the current user's playlists using the /v1/me/playlists endpoint.
 
-        API returns a maximum of 50 playlists at a time, so while 50 are
-        returned, requests next 50 using the offset API parameter to ensure
-        all playlists are found.
+        API returns a maximum of 50 playlists at a time, so once the first 50
+        (and the total number available) are returned, requests the rest of
+        them concurrently using the offset API parameter to ensure all
+        playlists are found.
 
         Return a dict with names mapping to playlist objects.
     """
     
-    headers = {}
-    headers["Authorization"] = "Bearer {}".format(accesstoken)
-
-    limit = 50
-
-    payload = {}
-    payload["limit"] = limit
-    payload["offset"] = 0
-
-    r = requests.get("https://api.spotify.com/v1/me/playlists",
-                        headers=headers, 
-                        params=payload)
-
-    # print('url = \n\n {} \n\n'.format(r.url))
-
-    response = r.json()
+    playlists = OrderedDict()
 
     # add data to playlist objects
-    if "items" not in response:
-        if response["error"]:
-            if response["error"]["status"] == 429:
-                # wait for the amount of time specified in response header
-                time.sleep(int(r.headers["Retry-After"]) + 1)
-                # try again
-                return(getplaylists(accesstoken, userid))
-
-            else:
-                print(response["error"])
-                return(None)
-        else:
+    for response in iterpages(PLAYLISTSURL, accesstoken, PLAYLISTPAGESIZE):
+        if response is None:
             print('error: getplaylists request failed')
             return(None)
 
-    numberreceived = len(response["items"])
-    totalavailable = response["total"]
+        addplaylists(playlists, response["items"])
 
-    playlists = OrderedDict()
+    return(playlists)
 
-    for playlist in response["items"]:
-        p = Playlist()
-        p.images = playlist["images"]
-        p.name = playlist["name"]
-        p.playlistid = playlist["id"]
-        p.ownerid = playlist["owner"]["id"]
-        playlists[p.name] = p
+@instruments.timed("stage_seconds", stage="getplaylistpage")
+def getplaylistpage(accesstoken, offset, limit=PLAYLISTPAGESIZE):
+    """
+        Get one page of the current user's playlists, the "limit" starting
+        at position "offset", for when they are needed before (or instead
+        of) all of them.
 
-    # if number received less than total available, request more
-    while numberreceived < totalavailable:
-        # print("received={} available={}".format(numberreceived, totalavailable))
-        payload["offset"] = payload["offset"] + limit
-        r = requests.get("https://api.spotify.com/v1/me/playlists",
-                        headers=headers, 
-                        params=payload)
-        response = r.json()
-
-        if "items" not in response:
-            if response["error"]:
-                if response["error"]["status"] == 429:
-                    # wait for the amount of time specified in response header
-                    time.sleep(int(r.headers["Retry-After"]) + 1)
-                    # try again
-                    continue
-                else:
-                    print('error: getplaylists request failed')
-                    print(response["error"])
-                    return(None)
-            else:
-                return(None)
+        Returns a list of playlist objects, one for each playlist on the
+        page (so some may share a name), and the total number of playlists
+        the user has, or None, None if there is an error.
+    """
+    payload = {}
+    payload["limit"] = limit
+    payload["offset"] = offset
 
-        for playlist in response["items"]:
-            p = Playlist()
-            p.images = playlist["images"]
-            p.name = playlist["name"]
-            p.playlistid = playlist["id"]
-            playlists[p.name] = p
+    response = client.get(PLAYLISTSURL, accesstoken, "items", payload)
+    if response is None:
+        print('error: getplaylistpage request failed')
+        return(None, None)
 
-        numberreceived = numberreceived + len(response["items"])
+    return([playlistfromitem(item) for item in response["items"]],
+           response["total"])
 
-    return(playlists)
+def addplaylists(playlists, items):
+    """
+        Add a Playlist object to the dict "playlists" for each playlist in a
+        page of items from the /v1/me/playlists endpoint.
+
+        No return value.
+    """
+    for item in items:
+        p = playlistfromitem(item)
+        playlists[p.name] = p
 
+def playlistfromitem(item):
+    """
+        Returns a Playlist object for one of the items of a page from the
+        /v1/me/playlists endpoint.
+    """
+    p = Playlist()
+    p.images = item["images"]
+    p.name = item["name"]
+    p.playlistid = item["id"]
+    p.ownerid = item["owner"]["id"]
+    p.snapshotid = item.get("snapshot_id")
+    return(p)
+
+@instruments.timed("stage_seconds", stage="getplaylisttracks")
 def getplaylisttracks(accesstoken, chosenplaylist):
     """
         Take a playlist object and fill out its 'tracks' attribute with a list
-        of track objects
+        of track objects. Pages after the first are requested concurrently.
 
         Returns a Playlist object with the tracks attribute complete, or None
         if there is an error.
     """
 
-    headers = {}
-    headers["Authorization"] = "Bearer {}".format(accesstoken)
+    table = None
+    for response in iterpages(playlisttracksurl(chosenplaylist), accesstoken,
+                              100):
+        if response is None:
+            print('error: getplaylisttracks request failed')
+            return(None)
 
-    limit = 100
+        if table is None:
+            table = TrackTable(capacity=response["total"])
+        addtracks(table, response["items"])
 
-    payload = {}
-    payload["limit"] = limit
-    payload["offset"] = 0
+    chosenplaylist.table = table
+    chosenplaylist.tracks = [Track(table, i) for i in range(len(table))]
 
-    r = requests.get(
-        "https://api.spotify.com/v1/users/{}/playlists/{}/tracks".format(chosenplaylist.ownerid, chosenplaylist.playlistid),
-        headers=headers,
-        params=payload)
+    # print(chosenplaylist.tracks)
+    return(chosenplaylist)
 
-    response = r.json()
+def playlisttracksurl(playlist):
 
-    if "items" not in response:
-        if response["error"]:
-            if response["error"]["status"] == 429:
-                # wait for the amount of time specified in response header
-                time.sleep(int(r.headers["Retry-After"]) + 1)
-                # try again
-                return(getplaylisttracks(accesstoken, chosenplaylist, userid))
-            else:
-                print(response["error"])
-                return(None)
-        else:
-            print('error: getplaylisttracks request failed')
-            return(None)
+    return("{}/v1/users/{}/playlists/{}/tracks"
+           .format(APIURL, playlist.ownerid, playlist.playlistid))
 
-    numberreceived = len(response["items"])
-    totalavailable = response["total"]
-
-    for track in response["items"]:
-        t = Track()
-        t.trackid = track["track"]["id"]
-        t.albumname = track["track"]["album"]["name"]
-        t.trackname = track["track"]["name"]
-        t.artistname = track["track"]["artists"][0]["name"]
-        t.popularity = track["track"]["popularity"]
-        # print(t.trackid, t.trackname, t.artistname, t.albumname)
-        chosenplaylist.tracks.append(t)
-
-    # if we haven't gotten all of the tracks in the playlist, request the next
-    # batch
-
-    while numberreceived < totalavailable:
-
-        payload["offset"] = payload["offset"] + limit
-        r = requests.get(
-        "https://api.spotify.com/v1/users/{}/playlists/{}/tracks".format(chosenplaylist.ownerid, chosenplaylist.playlistid),
-        headers=headers,
-        params=payload)
-        response = r.json()
-
-        if "items" not in response:
-            if response["error"]:
-                if response["error"]["status"] == 429:
-                    # wait for the amount of time specified in response header
-                    time.sleep(int(r.headers["Retry-After"]) + 1)
-                    # try again
-                    continue
-                else:
-                    print('error: getplaylisttracks request failed')
-                    print(response["error"])
-                    return(None)
-            else:
-                print('error: unknown error')
-                return(None)
+def addtracks(table, items):
+    """
+        Add the tracks in a page of items from the playlist tracks endpoint
+        to a TrackTable. Locally saved songs and tracks without an id are
+        skipped, as there is no way to query audio features without having a
+        spotify track id.
 
-        for track in response["items"]:
-            if track["is_local"]:
-                # a locally saved song. skip over it, as no way to query audio 
-                # features without having a spotify track id
-                continue
-            t = Track()
-            t.trackid = track["track"]["id"]
-            t.albumname = track["track"]["album"]["name"]
-            t.trackname = track["track"]["name"]
-            t.artistname = track["track"]["artists"][0]["name"]
-            # print(t.trackid, t.trackname, t.artistname, t.albumname)
-            chosenplaylist.tracks.append(t)
+        No return value.
+    """
+    for item in items:
+        track = item["track"]
+        if item.get("is_local") or not track or track["id"] is None:
+            continue
+        table.append(trackid=track["id"],
+                     albumname=track["album"]["name"],
+                     trackname=track["name"],
+                     artistname=track["artists"][0]["name"],
+                     popularity=track["popularity"])
+
+@instruments.timed("stage_seconds", stage="gettrackinfo")
+def gettrackinfo(accesstoken, playlist, cache=None):
+    """
+        Given a playlist object, fills the audio features for each track
+        object in the given playlist's list of tracks. If a FeatureCache is
+        given, tracks found in it aren't requested from spotify, and the
+        features of the rest are added to it.
 
-               
-        numberreceived = numberreceived + len(response["items"])
+        Returns True, or None if there is an error.
+    """
 
-    # filter out tracks with trackid == None
-    chosenplaylist.tracks = [track for track in chosenplaylist.tracks if track.trackid is not None]
+    # table rows holding each track id (a track can be in a playlist twice)
+    rows = OrderedDict()
+    for track in playlist.tracks:
+        rows.setdefault(track.trackid, []).append(track.index)
 
-    # print(chosenplaylist.tracks)
-    return(chosenplaylist)
+    if cache:
+        cached = cache.get(list(rows))
+    else:
+        cached = {}
+    for trackid, features in cached.items():
+        for index in rows[trackid]:
+            playlist.table.setfeatures(index, features)
+
+    needattributes = [trackid for trackid in rows if trackid not in cached]
+    fetched = {}
+
+    # request all the batches of 100 ids at once
+    batches = [needattributes[offset:offset + 100]
+               for offset in range(0, len(needattributes), 100)]
+    responses = getpages(FEATURESURL,
+                         accesstoken,
+                         [{'ids': ','.join(batch)} for batch in batches],
+                         "audio_features")
+    if responses is None:
+        print('error: gettrackinfo failed')
+        return(None)
 
-def gettrackinfo(accesstoken, playlist):
-    """
-        Given a playlist object, fills the audio features for each track
-        object in the given playlist's list of tracks.
+    for batch, response in zip(batches, responses):
+        fetched.update(fillfeatures(playlist.table, rows, batch, response))
 
-        No return value.
+    if cache:
+        cache.set(fetched)
+
+    return(True)
+
+@instruments.timed("stage_seconds", stage="getplaylistinfo")
+def getplaylistinfo(accesstoken, chosenplaylist, cache=None):
     """
+        Fill out a playlist's tracks and their audio features, as
+        getplaylisttracks followed by gettrackinfo would, but with the two
+        overlapping: the track ids on each page of the playlist go into
+        batches of 100 for the /audio-features endpoint, which are requested
+        while later pages are still downloading. Each page is added to the
+        track table as soon as it arrives rather than kept.
+
+        Returns a Playlist object with its tracks and their features filled
+        in, or None if there is an error.
+    """
+    table = None
+    rows = OrderedDict() # track id -> table rows holding it
+    found = {} # track id -> features, from the cache or spotify
+    pending = [] # track ids waiting for a full batch
+    batches = [] # (track ids, result of the request for their features)
 
-    headers = {}
-    headers["Authorization"] = "Bearer {}".format(accesstoken)
-
-    offset = 0
-
-    needattributes = [track.trackid for track in playlist.tracks]
-
-    while offset < len(needattributes):
-        params = {'ids': ','.join(needattributes[offset:100+offset])}
-        r = requests.get("https://api.spotify.com/v1/audio-features/",
-                         headers=headers,
-                         params=params)
-
-        response = r.json()
-
-        if "audio_features" not in response:
-            if response["error"]:
-                if response["error"]["status"] == 429:
-                    # wait correct amount
-                    time.sleep(int(r.headers["Retry-After"]) + 1)
-                    needinfo = True
-                    while needinfo:
-                        r = requests.get("https://api.spotify.com/v1/audio-features/",
-                                        headers=headers,
-                                        params=params)
-                        response = r.json()
-                        if "audio_features" in response:
-                            break
-                        elif response["error"]:
-                            if response["error"]["status"] == 429:
-                                # wait
-                                time.sleep(int(r.headers["Retry-After"]) + 1)
-                                continue
-                            else:
-                                print('error: gettrackinfo failed')
-                                print(response["error"])
-                                return(None)
-                else:
-                    print('error: gettrackinfo failed')
-                    print(response["error"])
-                    return(None)
-            else:
-                print('error: gettrackinfo failed')
-                print('no error response')
+    def fetch(batch):
+        return(client.get(FEATURESURL, accesstoken, "audio_features",
+                          {'ids': ','.join(batch)}))
+
+    def request(batch):
+        batches.append((batch, pool.apply_async(fetch, (batch,))))
+
+    pool = ThreadPool(PAGEWORKERS)
+    try:
+        for response in iterpages(playlisttracksurl(chosenplaylist),
+                                  accesstoken, 100):
+            if response is None:
+                print('error: getplaylistinfo request failed')
                 return(None)
 
-        for i in range(len(response["audio_features"])):
-            try:
-                playlist.tracks[i+offset].danceability = response["audio_features"][i]["danceability"]
-                playlist.tracks[i+offset].energy = response["audio_features"][i]["energy"]
-                playlist.tracks[i+offset].key = response["audio_features"][i]["key"]
-                playlist.tracks[i+offset].loudness = response["audio_features"][i]["loudness"]
-                playlist.tracks[i+offset].mode = response["audio_features"][i]["mode"]
-                playlist.tracks[i+offset].speechiness = response["audio_features"][i]["speechiness"]
-                playlist.tracks[i+offset].acousticness = response["audio_features"][i]["acousticness"]
-                playlist.tracks[i+offset].instrumentalness = response["audio_features"][i]["instrumentalness"]
-                playlist.tracks[i+offset].liveness = response["audio_features"][i]["liveness"]
-                playlist.tracks[i+offset].loudness = response["audio_features"][i]["loudness"]
-                playlist.tracks[i+offset].valence = response["audio_features"][i]["valence"]
-                playlist.tracks[i+offset].tempo = response["audio_features"][i]["tempo"]
-                playlist.tracks[i+offset].duration_ms = response["audio_features"][i]["duration_ms"]
-                playlist.tracks[i+offset].time_signature = response["audio_features"][i]["time_signature"]
-            except Exception as e:
-                print('error: error getting attributes from returned JSON')
-                print('this piece of json looks like:\n{}'.format(response["audiofeatures"][i]))
-
-        offset = offset + len(response["audio_features"])
-
-
-        # t.printattributes()
-
-def sortbyflow(playlist, flow="fastnn"):
+            if table is None:
+                table = TrackTable(capacity=response["total"])
+            start = len(table)
+            addtracks(table, response["items"])
+
+            # tracks not seen on earlier pages
+            new = []
+            for index in range(start, len(table)):
+                trackid = table.getvalue("trackid", index)
+                if trackid not in rows:
+                    rows[trackid] = []
+                    new.append(trackid)
+                rows[trackid].append(index)
+
+            if cache and new:
+                found.update(cache.get(new))
+            pending.extend([trackid for trackid in new if trackid not in found])
+            while len(pending) >= 100:
+                request(pending[:100])
+                pending = pending[100:]
+        if pending:
+            request(pending)
+
+        # features can only be set once every row is in the table, as a
+        # track can be on the playlist more than once
+        for trackid, features in found.items():
+            for index in rows[trackid]:
+                table.setfeatures(index, features)
+        fetched = {}
+        for batch, result in batches:
+            response = result.get()
+            if response is None:
+                print('error: getplaylistinfo request failed')
+                return(None)
+            fetched.update(fillfeatures(table, rows, batch, response))
+    finally:
+        pool.terminate()
+
+    if cache:
+        cache.set(fetched)
+
+    chosenplaylist.table = table
+    chosenplaylist.tracks = [Track(table, i) for i in range(len(table))]
+    return(chosenplaylist)
+
+def fillfeatures(table, rows, batch, response):
+    """
+        Set the features in a response from the /audio-features endpoint on
+        the table rows holding each track id of the batch that was
+        requested. "rows" maps track ids to lists of rows.
+
+        Returns a dict mapping the track ids that were given features to
+        those features.
+    """
+    fetched = {}
+    for trackid, features in zip(batch, response["audio_features"]):
+        try:
+            for index in rows[trackid]:
+                table.setfeatures(index, features)
+            fetched[trackid] = features
+        except Exception as e:
+            print('error: error getting attributes from returned JSON')
+            print('this piece of json looks like:\n{}'.format(features))
+    return(fetched)
+
+# most tracks to use mstflow on, since finding each track's closest tracks
+# takes time quadratic in the number of tracks (see sort.neighborlists)
+MSTLIMIT = 20000
+
+def sortbyflow(playlist, flow="fastnn", refine=False, refinetime=None,
+               size=50, workers=None, profile=None):
     """
         Takes in a Playlist object with Tracks filled with attributes, applies
-        flow algorithm to group songs (For now just sorts by the valence
-        attribute, TODO: something more sophisticated.)
+        flow algorithm to group songs. "flow" is one of "simple", "fullnn",
+        "vectornn" (fullnn computed with numpy), "kdnn" (fullnn using a k-d
+        tree), "mst" (walk of a minimum spanning tree, keeps the largest jump
+        small), "cluster" (orders clusters of similar tracks, for very large
+        playlists), "hilbert" (order along a space filling curve, near
+        linear, a quick start for "refine") or "fastnn" (the default). If
+        "refine" is set, the result is then improved with 2-opt/Or-opt moves
+        for at most "refinetime" seconds (or until no more improvements are
+        found if None). "size" and "workers" set the segment size and number
+        of worker processes for "fastnn" ("workers" also for "cluster").
+        "profile" (a FlowProfile, or anything flowprofiles.getprofile takes)
+        sets the attribute weights, normalization and distance metric the
+        flows use; "kdnn" and "mst" don't support manhattan distance, and
+        "mst" doesn't take playlists of more than MSTLIMIT tracks.
 
         Returns a list of track URIs in the newly sorted order, or None if
         there is an error.
     """
     try:
-        if flow == "simple":
-            sortedlist = sort.simpleflow(playlist)
-        elif flow == "fullnn":
-            sortedlist = sort.fullnnflow(playlist)
-        else:
-            sortedlist = sort.fastnnflow(playlist)
+        with instruments.timer("stage_seconds", stage="sortbyflow", flow=flow):
+            if flow == "simple":
+                sortedlist = sort.simpleflow(playlist)
+            elif flow == "fullnn":
+                sortedlist = sort.fullnnflow(playlist, profile)
+            elif flow == "vectornn":
+                sortedlist = sort.vectornnflow(playlist, profile)
+            elif flow == "kdnn":
+                sortedlist = sort.kdnnflow(playlist, profile)
+            elif flow == "mst":
+                if len(playlist.tracks) > MSTLIMIT:
+                    raise ValueError("mst takes at most {} tracks, not {}"
+                                     .format(MSTLIMIT, len(playlist.tracks)))
+                sortedlist = sort.mstflow(playlist, profile)
+            elif flow == "cluster":
+                sortedlist = sort.clusterflow(playlist, workers=workers,
+                                              profile=profile)
+            elif flow == "hilbert":
+                sortedlist = sort.hilbertflow(playlist, profile=profile)
+            else:
+                sortedlist = sort.fastnnflow(playlist, size=size,
+                                             workers=workers, profile=profile)
+        if refine:
+            with instruments.timer("stage_seconds", stage="refine"):
+                sortedlist = localsearch.refine(sortedlist,
+                                                timelimit=refinetime,
+                                                profile=profile)
         sorteduris = ["spotify:track:{}".format(track.trackid) for track in sortedlist]
     except Exception as e:
         print("error: sorting in sortbyflow failed")
@@ -448,18 +581,54 @@ def sortbyflow(playlist, flow="fastnn"):
 
     return(sorteduris)
 
-def createspotifyplaylist(accesstoken, name, playlists, tracklist, userid):
+@instruments.timed("stage_seconds", stage="createspotifyplaylist")
+def createspotifyplaylist(accesstoken, name, playlists, tracklist, userid,
+                          playlistname=None):
     """
         Use the given tracklist to create a new playlist on spotify with the 
         name "{name} - flowed", or "{name} - flowed (1)" if "{name} - flowed" 
         already exists, or "{name} - flowed ({n})" if "{name} - flowed ({n-1})"
         exists. Takes in playlists (dict of user's playlists) to check whether
-        names are taken.
+        names are taken, unless the name to use is given as "playlistname".
 
         Returns True if successful, False if unsuccessful.
     """
 
     # find a unique name for the playlist
+    if playlistname is None:
+        playlistname = flowedname(name, playlists)
+
+    # create playlist
+    payload = {}
+    payload["name"] = playlistname
+
+    url = "{}/v1/users/{}/playlists".format(APIURL, userid)
+
+    # a failed create might still have made the playlist, so only rate
+    # limited requests are retried, to avoid making it twice
+    response = client.post(url, accesstoken, "collaborative", json=payload,
+                           retryerrors=False)
+    if response is None:
+        print("error: problem creating spotify playlist")
+        return(False)
+
+    playlistid = response["id"]
+    playlisturl = response["external_urls"]["spotify"]
+
+    # add tracks to playlist
+    tracksurl = "{}/v1/users/{}/playlists/{}/tracks".format(APIURL, userid, playlistid)
+    if not addplaylisttracks(accesstoken, tracksurl, tracklist):
+        print("error: problem adding songs to playlist")
+        return(False)
+
+    return(playlistname, playlisturl)
+    
+
+def flowedname(name, playlists):
+    """
+        Returns the first of "{name} - flowed", "{name} - flowed (1)", ...
+        that isn't in playlists (any collection of playlist names).
+    """
     playlistname = "{} - flowed".format(name)
     if playlistname in playlists:
         num = 1
@@ -467,136 +636,519 @@ def createspotifyplaylist(accesstoken, name, playlists, tracklist, userid):
         while playlistname in playlists:
             num = num + 1
             playlistname = "{} - flowed ({})".format(name, num)
+    return(playlistname)
 
-    # create playlist
-    headers = {}
-    headers["Authorization"] = "Bearer {}".format(accesstoken)
-    headers["Content-Type"] = "application/json"
+def addplaylisttracks(accesstoken, url, tracklist, attempts=3,
+                      window=PAGEWORKERS):
+    """
+        Add a list of track URIs to an empty playlist (whose tracks endpoint
+        is url) in order, 100 at a time. Spotify only accepts a position up
+        to the current length of the playlist, so chunks can't each be sent
+        straight to their own place at once. Instead they are all appended,
+        up to "window" requests at a time (see appendchunks), and land in
+        the order spotify happens to apply them, which is checked and fixed
+        afterwards (see orderchunks). A chunk of less than 100 tracks goes
+        first, on its own, so that the rest all start at a multiple of 100
+        from it. Telling where each chunk landed needs their first tracks to
+        differ, so a chunk starting with the same track as one before it
+        waits for those to be done.
+
+        Returns True if successful, None if there is an error.
+    """
+    first = len(tracklist) % 100 or 100
+    chunks = [tracklist[:first]]
+    chunks.extend(tracklist[i:i + 100]
+                  for i in range(first, len(tracklist), 100))
+
+    length = 0
+    while chunks:
+        if len(chunks[0]) < 100:
+            batch = chunks[:1]
+        else:
+            firsts = set()
+            batch = []
+            for chunk in chunks:
+                if chunk[0] in firsts:
+                    break
+                firsts.add(chunk[0])
+                batch.append(chunk)
+
+        if len(batch) == 1:
+            added = insertchunk(accesstoken, url, batch[0], length, attempts)
+        else:
+            added = appendchunks(accesstoken, url, batch, length, attempts,
+                                 window)
+        if not added:
+            return(None)
+        length = length + sum(len(chunk) for chunk in batch)
+        chunks = chunks[len(batch):]
+    return(True)
 
-    payload = {}
-    payload["name"] = playlistname
+def insertchunk(accesstoken, url, chunk, position, attempts=3):
+    """
+        Helper function for addplaylisttracks to add one chunk of tracks at
+        "position", the current end of the playlist. A failed request might
+        still have been applied, so it isn't retried blindly: the playlist's
+        length is read back, and the chunk is sent again (up to "attempts"
+        times in all) only if it isn't there.
 
-    url = "https://api.spotify.com/v1/users/{}/playlists".format(userid)
-
-    r = requests.post(url, headers=headers, json=payload)
-
-    response = r.json()
-
-
-    if "collaborative" not in response:
-        if response["error"]:
-            if response["error"]["status"] == 429:
-                retry = True
-                while retry:
-                    time.sleep(int(r.headers["Retry-After"]) + 1)
-                    r = requests.post(url, headers=headers, json=payload)
-                    response = r.json()
-                    if response["error"]:
-                        if response["error"]["status"] == 429:
-                            continue
-                        else:
-                            print("error: problem creating spotify playlist")
-                            print(response["error"])
-                            return(False)
-                    elif "collaborative" in response:
-                        break
-                    else:
-                        print("error: problem creating spotify playlist")
-                        print('no error response')
-                        return(False)
-            else: 
-                print("error: problem creating spotify playlist")
-                print(response["error"])
-                return(False)
+        Returns True if successful, None if there is an error.
+    """
+    for attempt in range(attempts):
+        # only rate limited requests are retried by the client
+        if client.post(url, accesstoken, "snapshot_id",
+                       json={"uris": chunk, "position": position},
+                       retryerrors=False) is not None:
+            return(True)
+        length = getplaylistlength(accesstoken, url)
+        if length == position + len(chunk):
+            return(True)
+        if length != position:
+            print('error: playlist has {} tracks, expected {}'.format(
+                length, position))
+            return(None)
+    print('error: tracks {} to {} could not be added'.format(
+        position, position + len(chunk)))
+    return(None)
+
+def appendchunks(accesstoken, url, chunks, length, attempts=3,
+                 window=PAGEWORKERS):
+    """
+        Helper function for addplaylisttracks to append chunks of 100 tracks
+        to a playlist of "length" tracks, "window" requests at a time, and
+        then put them in order. The requests are started WRITESTAGGER
+        seconds apart, so that they mostly land in order and few need
+        moving. Where each chunk landed is found by reading the first track
+        at every multiple of 100 past "length" (see chunkstarts). A chunk
+        whose request failed is sent again (up to "attempts" times in all)
+        only if it isn't among them, since a failed request might still have
+        been applied.
+
+        Returns True if successful, None if there is an error.
+    """
+    firsts = dict((chunk[0], i) for i, chunk in enumerate(chunks))
+
+    def append(item):
+        i, chunk = item
+        time.sleep(max(0, started + i * WRITESTAGGER - time.time()))
+        # only rate limited requests are retried by the client
+        return(client.post(url, accesstoken, "snapshot_id",
+                           json={"uris": chunk}, retryerrors=False))
+
+    pending = list(chunks)
+    landed = []
+    pool = ThreadPool(min(window, len(chunks)))
+    try:
+        for attempt in range(attempts):
+            started = time.time()
+            sent = pool.map(append, enumerate(pending), chunksize=1)
+            # the playlist's length is only in doubt if a request failed
+            total = None
+            if None not in sent:
+                total = length + 100 * (len(landed) + len(pending))
+            landed = chunkstarts(accesstoken, url, length, firsts, pool,
+                                 total)
+            if landed is None:
+                return(None)
+            if len(set(landed)) < len(landed):
+                print('error: tracks added to playlist twice')
+                return(None)
+            if len(landed) == len(chunks):
+                break
+            pending = [chunk for i, chunk in enumerate(chunks)
+                       if i not in set(landed)]
         else:
-            print("error: problem creating spotify playlist")
-            print('no error response')
-            return(False)
+            print('error: tracks {} to {} could not be added'.format(
+                length, length + 100 * len(chunks)))
+            return(None)
+    finally:
+        pool.close()
+        pool.join()
 
-    playlistid = response["id"]
-    playlisturl = response["external_urls"]["spotify"]
+    return(orderchunks(accesstoken, url, landed, length, firsts, attempts))
 
-    # add tracks to playlist
-    while len(tracklist) > 100:
-
-        # add first 100
-        headers = {}
-        headers["Authorization"] = "Bearer {}".format(accesstoken)
-        headers["Content-Type"] = "application/json"
-
-        payload = {}
-        payload["uris"] = tracklist[:100]
-
-        r = requests.post("https://api.spotify.com/v1/users/{}/playlists/{}/tracks"
-                        .format(userid, playlistid),
-                        headers=headers,
-                        json=payload)
-
-        response = r.json()
-        if "snapshot_id" not in response:
-            if response["error"]:
-                if response["error"]["status"] == 429:
-                    time.sleep(int(r.headers["Retry-After"]) + 1)
-                    continue
-                else:
-                    print("error: problem adding songs to playlist")
-                    print(response["error"])
-                    return(False)
+def chunkstarts(accesstoken, url, length, firsts, pool, total=None):
+    """
+        Helper function for appendchunks to find which chunk is at each
+        multiple of 100 from position "length" to the end of the playlist
+        ("total" tracks long, read from spotify if None), from its first
+        track ("firsts" maps each chunk's first track to its index), reading
+        one track from each at once on "pool".
+
+        Returns a list of chunk indices in playlist order, or None if there
+        is an error or a track that doesn't start a chunk is found.
+    """
+    if total is None:
+        total = getplaylistlength(accesstoken, url)
+    if total is None:
+        return(None)
+
+    def first(offset):
+        return(client.get(url, accesstoken, "items",
+                          {"offset": offset, "limit": 1,
+                           "fields": "items(track(uri))"}))
+
+    landed = []
+    for response in pool.map(first, range(length, total, 100)):
+        uri = response["items"][0]["track"]["uri"] if response else None
+        if uri not in firsts:
+            print('error: unexpected tracks in playlist')
+            return(None)
+        landed.append(firsts[uri])
+    return(landed)
+
+def orderchunks(accesstoken, url, landed, length, firsts, attempts=3):
+    """
+        Helper function for appendchunks to move chunks of 100 tracks,
+        starting at position "length" in the order given by "landed" (a
+        list of chunk indices), into index order. Working from the first
+        chunk on, the next chunk wanted is moved into place along with any
+        chunks that already follow it in the right order, in one reorder
+        request. Each request is made against the snapshot the
+        one before it returned. If one fails, where the chunks are is read
+        again before carrying on (up to "attempts" failures in all).
+
+        Returns True if successful, None if there is an error.
+    """
+    snapshot = None
+    failures = 0
+    for target in range(len(landed)):
+        while landed[target] != target:
+            current = landed.index(target)
+            run = 1
+            while current + run < len(landed) and \
+                    landed[current + run] == target + run:
+                run = run + 1
+            body = {"range_start": length + 100 * current,
+                    "range_length": 100 * run,
+                    "insert_before": length + 100 * target}
+            if snapshot is not None:
+                body["snapshot_id"] = snapshot
+            response = client.request("PUT", url, accesstoken, "snapshot_id",
+                                      retryerrors=False, json=body)
+            if response is not None:
+                snapshot = response["snapshot_id"]
+                moved = landed[current:current + run]
+                del landed[current:current + run]
+                landed[target:target] = moved
+                continue
+
+            failures = failures + 1
+            pool = ThreadPool(min(PAGEWORKERS, len(landed)))
+            try:
+                landed = chunkstarts(accesstoken, url, length, firsts, pool)
+            finally:
+                pool.close()
+                pool.join()
+            if failures >= attempts or landed is None \
+                    or sorted(landed) != list(range(len(firsts))):
+                print('error: tracks {} to {} could not be put in order'
+                      .format(length, length + 100 * len(firsts)))
+                return(None)
+            snapshot = None
+    return(True)
+
+def getplaylistlength(accesstoken, url):
+    """
+        Returns the number of tracks on the playlist whose tracks endpoint
+        is url, or None if there is an error.
+    """
+    response = client.get(url, accesstoken, "total",
+                          {"limit": 1, "fields": "total"})
+    if response is None:
+        print('error: getplaylistlength request failed')
+        return(None)
+    return(response["total"])
+
+# Batch mode, to flow many playlists of one account from the command line
+# (e.g. overnight) without the web app or redis:
+#
+#     SPOTIFY_TOKEN=<access token> SPOTIFY_REFRESH_TOKEN=<refresh token> \
+#     python clplaylistflow.py --all --state batch.jsonl
+#     python clplaylistflow.py --token <access token> <playlist id> ...
+#
+# Up to "--concurrency" playlists are fetched, sorted and written back (as
+# new "<name> - flowed" playlists, as the web app does) at once. Every request
+# goes through the shared SpotifyClient, so a rate limited response holds
+# back all of them until its Retry-After has passed. A line of JSON is
+# written when each playlist starts and when it's done or failed, with the
+# seconds spent fetching, sorting and writing it; with "--state" the same
+# lines are appended to a file, after a first line listing the playlists in
+# the batch, and a later run with the same file skips the playlists already
+# done (and with "--all" leaves out any made since the batch started, like
+# its own flowed copies), so a batch that crashed can be carried on. (A
+# playlist that was being written when it crashed is made again, so it may
+# leave a partial copy behind.) The access token is refreshed as needed if
+# a refresh token (and APPID and APPSECRET) is given.
+
+# flows sortbyflow knows, the first being the default
+FLOWS = ["fastnn", "simple", "fullnn", "vectornn", "kdnn", "mst", "cluster",
+         "hilbert"]
+
+class BatchToken():
+
+    def __init__(self, accesstoken, refreshtoken=None, expiresin=3600,
+                 margin=300):
+
+        self.lock = threading.Lock()
+        self.accesstoken = accesstoken
+        self.refreshtoken = refreshtoken
+        self.margin = margin # seconds of validity left to refresh at
+        self.expiresat = time.time() + float(expiresin)
+
+    def get(self):
+        """
+            Returns the access token, refreshed first if it has less than
+            margin seconds left and there is a refresh token. One thread
+            refreshes it while any others wait.
+        """
+        with self.lock:
+            if self.refreshtoken and \
+                    self.expiresat - time.time() < self.margin:
+                accesstoken, refreshtoken, expiresin = \
+                    refreshtokens(self.refreshtoken)
+                if accesstoken is not None:
+                    self.accesstoken = accesstoken
+                    self.refreshtoken = refreshtoken
+                    self.expiresat = time.time() + float(expiresin)
+            return(self.accesstoken)
+
+def getallplaylists(accesstoken):
+    """
+        Get every one of the current user's playlists, like getplaylists but
+        keeping playlists that share a name.
+
+        Returns a list of Playlist objects, or None if there is an error.
+    """
+    playlists = []
+    for response in iterpages(PLAYLISTSURL, accesstoken, PLAYLISTPAGESIZE):
+        if response is None:
+            print('error: getallplaylists request failed')
+            return(None)
+        playlists.extend(playlistfromitem(item) for item in response["items"])
+    return(playlists)
+
+def readbatchstate(path):
+    """
+        Read the lines written to a batch state file by earlier runs. A last
+        line cut short by a crash is ignored.
+
+        Returns a dict of playlist id -> the last line for that playlist and
+        the list of playlist ids the batch started with, or an empty dict
+        and None if there is no file.
+    """
+    lines = {}
+    batch = None
+    if not path or not os.path.exists(path):
+        return(lines, batch)
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "batch" in entry and batch is None:
+                batch = entry["batch"]
+            elif "playlist" in entry:
+                lines[entry["playlist"]] = entry
+    return(lines, batch)
+
+def flowbatchplaylist(playlist, token, userid, names, lock, flow="fastnn",
+                      profile=None, refine=False, refinetime=None):
+    """
+        Fetch, sort and write back one playlist for batch mode. "names" is
+        the set of the user's playlist names, shared by the whole batch
+        (guarded by "lock"), so the new playlists all get different names.
+
+        Returns a dict with the playlist's id and name, its "status" ("done"
+        or "failed"), the "error" if it failed or the name and url of the
+        new playlist if not, the number of tracks and the seconds each step
+        took.
+    """
+    result = OrderedDict([("playlist", playlist.playlistid),
+                          ("name", playlist.name)])
+    seconds = OrderedDict()
+    start = timeit.default_timer()
+
+    def finish(error=None, **fields):
+        seconds["total"] = timeit.default_timer() - start
+        result["status"] = "failed" if error else "done"
+        if error:
+            result["error"] = error
+        result.update(sorted(fields.items()))
+        result["seconds"] = seconds
+        return(result)
+
+    step = timeit.default_timer()
+    filled = getplaylistinfo(token.get(), playlist)
+    seconds["fetch"] = timeit.default_timer() - step
+    if filled is None:
+        return(finish("couldn't get the playlist's songs"))
+    result["tracks"] = len(filled.tracks)
+    if not filled.tracks:
+        return(finish("the playlist has no spotify songs"))
+
+    # sorted in this thread: the batch's other threads keep the CPU busy,
+    # and starting worker processes from a threaded one isn't safe
+    step = timeit.default_timer()
+    tracklist = sortbyflow(filled, flow=flow, refine=refine,
+                           refinetime=refinetime, workers=1, profile=profile)
+    seconds["sort"] = timeit.default_timer() - step
+    if not tracklist:
+        return(finish("sorting the playlist failed"))
+
+    with lock:
+        playlistname = flowedname(playlist.name, names)
+        names.add(playlistname)
+    step = timeit.default_timer()
+    created = createspotifyplaylist(token.get(), playlist.name, names,
+                                    tracklist, userid, playlistname)
+    seconds["write"] = timeit.default_timer() - step
+    if not created:
+        return(finish("couldn't create the new playlist"))
+    return(finish(newname=created[0], url=created[1]))
+
+def runbatch(args, out):
+    """
+        Flow the playlists asked for on the command line (see main), writing
+        a line of JSON to out as each starts and finishes, and a summary
+        line at the end.
+
+        Returns 0 if every playlist was flowed, 1 if any failed, or 2 if the
+        batch couldn't start.
+    """
+    token = BatchToken(args.token, args.refreshtoken, args.expiresin)
+    profile = FlowProfile(args.weights, args.normalization, args.metric)
+
+    userid = getuserid(token.get())
+    playlists = getallplaylists(token.get()) if userid else None
+    if playlists is None:
+        print("error: couldn't get the user's playlists")
+        return(2)
+    names = set(playlist.name for playlist in playlists)
+
+    previous, batch = readbatchstate(args.state)
+    chosenids = args.playlists
+    if args.all and batch is not None:
+        # carry on with the playlists the batch started with
+        chosenids = batch
+    if chosenids:
+        byid = dict((playlist.playlistid, playlist) for playlist in playlists)
+        chosen = []
+        for playlistid in chosenids:
+            if playlistid in byid:
+                chosen.append(byid[playlistid])
             else:
-                print("error: problem adding songs to playlist")
-                print("no error response")
-                return(False)
-
-        tracklist = tracklist[100:]
-
-    if tracklist:
-
-        # add the remainder of the tracks
-        headers = {}
-        headers["Authorization"] = "Bearer {}".format(accesstoken)
-        headers["Content-Type"] = "application/json"
-
-        payload = {}
-        payload["uris"] = tracklist
-
-        r = requests.post("https://api.spotify.com/v1/users/{}/playlists/{}/tracks"
-                        .format(userid, playlistid),
-                        headers=headers,
-                        json=payload)
-
-        response = r.json()
-        if "snapshot_id" not in response:
-            if response["error"]:
-                if response["error"]["status"] == 429:
-                    retry = True
-                    while retry:
-                        time.sleep(int(r.headers["Retry-After"]) + 1)
-                        r = requests.post("https://api.spotify.com/v1/users/{}/playlists/{}/tracks"
-                        .format(userid, playlistid),
-                        headers=headers,
-                        json=payload)
-                        response = r.json()
-                        if "snapshot_id" in response:
-                            break
-                        elif response["error"]:
-                            if response["error"]["status"] == 429:
-                                continue
-                            else:
-                                print("error: createspotifyplaylist request failed")
-                                print(response["error"])
-                                return(False)
-                        else:
-                            print("error: createspotifyplaylist request failed")
-                            print("no error response")
-                            return(False)
-                else:
-                    print("error: createspotifyplaylist request failed")
-                    print(response["error"])
-                    return(False)
+                print("error: no playlist {} in the user's playlists".format(
+                    playlistid))
+        playlists = chosen
+
+    statefile = open(args.state, "a") if args.state else None
+    lock = threading.Lock()
+    if statefile is not None and batch is None:
+        statefile.write(json.dumps({"batch": [playlist.playlistid
+                                              for playlist in playlists]})
+                        + "\n")
+
+    def emit(line):
+        text = json.dumps(line) + "\n"
+        with lock:
+            out.write(text)
+            out.flush()
+            if statefile is not None:
+                statefile.write(text)
+                statefile.flush()
+                os.fsync(statefile.fileno())
+
+    def run(playlist):
+        emit(OrderedDict([("playlist", playlist.playlistid),
+                          ("name", playlist.name), ("status", "started")]))
+        try:
+            result = flowbatchplaylist(playlist, token, userid, names, lock,
+                                       args.flow, profile, args.refine,
+                                       args.refinetime)
+        except Exception as e:
+            traceback.print_exc()
+            result = OrderedDict([("playlist", playlist.playlistid),
+                                  ("name", playlist.name),
+                                  ("status", "failed"), ("error", str(e))])
+        emit(result)
+        return(result["status"] == "done")
+
+    start = timeit.default_timer()
+    results = []
+    try:
+        todo = []
+        for playlist in playlists:
+            if previous.get(playlist.playlistid, {}).get("status") == "done":
+                emit(OrderedDict([("playlist", playlist.playlistid),
+                                  ("name", playlist.name),
+                                  ("status", "skipped")]))
             else:
-                print("error: createspotifyplaylist request failed")
-                print("no error response")
-                return(False)
+                todo.append(playlist)
 
-    return(playlistname, playlisturl)
-    
\ No newline at end of file
+        if todo:
+            pool = ThreadPool(min(args.concurrency, len(todo)))
+            try:
+                results = pool.map(run, todo)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if statefile is not None:
+            statefile.close()
+
+    summary = OrderedDict([("done", results.count(True)),
+                           ("failed", results.count(False)),
+                           ("skipped", len(playlists) - len(results)),
+                           ("seconds", timeit.default_timer() - start)])
+    out.write(json.dumps({"summary": summary}) + "\n")
+    out.flush()
+    return(1 if summary["failed"] else 0)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Flow many of a user's playlists at once.")
+    parser.add_argument("playlists", nargs="*",
+                        help="ids of the playlists to flow")
+    parser.add_argument("--all", action="store_true",
+                        help="flow all of the user's playlists")
+    parser.add_argument("--token", default=os.environ.get("SPOTIFY_TOKEN"),
+                        help="access token (default $SPOTIFY_TOKEN)")
+    parser.add_argument("--refreshtoken",
+                        default=os.environ.get("SPOTIFY_REFRESH_TOKEN"),
+                        help="refresh token, to keep the access token valid "
+                        "through a long batch (default $SPOTIFY_REFRESH_TOKEN)")
+    parser.add_argument("--expiresin", type=float, default=3600,
+                        help="seconds the access token has left")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="playlists to flow at once")
+    parser.add_argument("--flow", default=FLOWS[0], choices=FLOWS)
+    parser.add_argument("--weights", default="default", choices=list(PROFILES))
+    parser.add_argument("--normalization", default="fixed",
+                        choices=NORMALIZATIONS)
+    parser.add_argument("--metric", default="euclidean", choices=METRICS)
+    parser.add_argument("--refine", action="store_true",
+                        help="improve each order with local search")
+    parser.add_argument("--refinetime", type=float, default=2,
+                        help="seconds of local search per playlist")
+    parser.add_argument("--state",
+                        help="file to record progress in and resume from")
+    args = parser.parse_args(argv)
+
+    if not args.token:
+        parser.error("an access token is needed (--token or $SPOTIFY_TOKEN)")
+    if not args.all and not args.playlists:
+        parser.error("give playlist ids or --all")
+
+    # the lines of JSON go to stdout, and everything else printed to stderr
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        return(runbatch(args, out))
+    finally:
+        sys.stdout = out
+
+if __name__ == "__main__":
+    sys.exit(main())
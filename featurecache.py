@@ -0,0 +1,145 @@
+# FeatureCache class to keep audio features from the /audio-features endpoint
+# The features of a given track id never change and many users share popular
+# tracks, so features are cached in redis for every user and request to use,
+# with an optional least-recently-used cache inside this process in front.
+#
+# To keep redis memory use bounded, entries are kept in two hashes: new
+# entries (and entries read from the older hash) go into the current one, and
+# once it holds half of "maxentries" it replaces the older one, which is
+# dropped. Tracks that haven't been looked up for a while are therefore the
+# ones evicted, and about "maxentries" tracks are stored at most.
+
+import json
+import threading
+from collections import OrderedDict
+
+from instrument import instruments
+from tracktable import FEATURES
+
+class FeatureCache():
+
+    def __init__(self, redisconnection, maxentries=500000, lrusize=20000,
+                 prefix="audiofeatures"):
+
+        self.redis = redisconnection
+        self.maxentries = maxentries
+        self.lrusize = lrusize # 0 turns off the in-process cache
+        self.currentkey = "{}:current".format(prefix)
+        self.olderkey = "{}:older".format(prefix)
+        self.rotatekey = "{}:rotating".format(prefix)
+
+        self.lru = OrderedDict() # track id -> features, oldest first
+        self.lock = threading.Lock()
+
+    @instruments.timed("redis_seconds", op="featurecache.get")
+    def get(self, trackids):
+        """
+            Look up the audio features of a list of track ids, first in this
+            process, then in redis with one round trip for all of them.
+
+            Returns a dict mapping each track id found to its features (a
+            dict like one entry of the /audio-features response).
+        """
+        found = {}
+        remaining = []
+        with self.lock:
+            for trackid in set(trackids):
+                if trackid in self.lru:
+                    found[trackid] = self.lru.pop(trackid)
+                    self.lru[trackid] = found[trackid]
+                else:
+                    remaining.append(trackid)
+        localhits = len(found)
+
+        fromredis = {}
+        promote = {}
+        if remaining:
+            pipe = self.redis.pipeline()
+            pipe.hmget(self.currentkey, remaining)
+            pipe.hmget(self.olderkey, remaining)
+            current, older = pipe.execute()
+            for trackid, new, old in zip(remaining, current, older):
+                if new is not None:
+                    fromredis[trackid] = unpack(new)
+                elif old is not None:
+                    fromredis[trackid] = unpack(old)
+                    promote[trackid] = old
+        found.update(fromredis)
+
+        # served from this process, from redis, or not cached at all
+        instruments.count("featurecache_lookups_total", localhits,
+                          result="local")
+        instruments.count("featurecache_lookups_total", len(fromredis),
+                          result="redis")
+        instruments.count("featurecache_lookups_total",
+                          len(remaining) - len(fromredis), result="miss")
+        if promote:
+            self.redis.hmset(self.currentkey, promote)
+            self.rotate()
+
+        self.remember(fromredis)
+        return(found)
+
+    @instruments.timed("redis_seconds", op="featurecache.set")
+    def set(self, features):
+        """
+            Store audio features, given as a dict mapping track ids to
+            features, in redis and in this process.
+
+            No return value.
+        """
+        if not features:
+            return
+        self.redis.hmset(self.currentkey,
+                         dict((trackid, pack(values))
+                              for trackid, values in features.items()))
+        self.rotate()
+        self.remember(features)
+
+    def remember(self, features):
+        """
+            Add features to the in-process cache, dropping the least recently
+            used entries beyond lrusize.
+        """
+        if not self.lrusize:
+            return
+        with self.lock:
+            for trackid, values in features.items():
+                self.lru.pop(trackid, None)
+                self.lru[trackid] = values
+            while len(self.lru) > self.lrusize:
+                self.lru.popitem(last=False)
+
+    def rotate(self):
+        """
+            Once the current hash holds half of maxentries, make it the older
+            hash, dropping the previous older one. Only one process does this
+            at a time.
+        """
+        if self.redis.hlen(self.currentkey) < self.maxentries // 2:
+            return
+        if not self.redis.set(self.rotatekey, 1, nx=True, ex=30):
+            return
+        try:
+            if self.redis.hlen(self.currentkey) >= self.maxentries // 2:
+                self.redis.rename(self.currentkey, self.olderkey)
+        finally:
+            self.redis.delete(self.rotatekey)
+
+
+def pack(features):
+    """
+        Returns the values of an /audio-features entry as a compact JSON
+        list, in tracktable.FEATURES order.
+    """
+    return(json.dumps([features[name] for name, dtype in FEATURES],
+                      separators=(",", ":")))
+
+
+def unpack(packed):
+    """
+        Returns the features dict packed by pack.
+    """
+    if isinstance(packed, bytes):
+        packed = packed.decode("utf-8")
+    return(dict(zip([name for name, dtype in FEATURES], json.loads(packed))))
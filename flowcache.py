@@ -0,0 +1,170 @@
+# FlowCache class to keep the results of sorting playlists with a flow
+# algorithm in redis, so flowing the same playlist again (or any playlist
+# with the same tracks in the same order) with the same algorithm and
+# parameters doesn't repeat the work.
+#
+# Results are keyed by a digest of the playlist's track ids, the flow and its
+# parameters. As spotify gives every version of a playlist a new snapshot id,
+# the digest is also remembered for the playlist id and snapshot id it came
+# from, so an unchanged playlist can be looked up before its tracks are even
+# fetched.
+#
+# Like FeatureCache, entries are kept in two hashes, the current one being
+# made the older one once it holds half of "maxentries", and entries older
+# than "ttl" seconds are treated as missing.
+
+import hashlib
+import json
+import time
+
+from instrument import instruments
+
+class FlowCache():
+
+    def __init__(self, redisconnection, ttl=604800, maxentries=5000,
+                 prefix="flowcache", bypass=False):
+
+        self.redis = redisconnection
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.bypass = bypass # look nothing up and store nothing, to debug
+        self.currentkey = "{}:current".format(prefix)
+        self.olderkey = "{}:older".format(prefix)
+        self.rotatekey = "{}:rotating".format(prefix)
+
+    @instruments.timed("redis_seconds", op="flowcache.get")
+    def get(self, trackids, flow, params):
+        """
+            Look up the result of sorting tracks with the given ids, in
+            order, with flow algorithm "flow" and its parameters (a dict).
+
+            Returns the sorted list of track URIs (as returned by
+            clplaylistflow.sortbyflow), or None if it isn't cached.
+        """
+        if self.bypass:
+            return(None)
+        return(uris(self.read("r:" + resultdigest(trackids, flow, params))))
+
+    @instruments.timed("redis_seconds", op="flowcache.getsnapshot")
+    def getsnapshot(self, playlistid, snapshotid, flow, params):
+        """
+            Look up the result of sorting a playlist as it was at spotify
+            snapshot "snapshotid". See get.
+
+            Returns the sorted list of track URIs, or None if it isn't
+            cached.
+        """
+        if self.bypass or not snapshotid:
+            return(None)
+        digest = self.read(snapshotkey(playlistid, snapshotid, flow, params))
+        if digest is None:
+            return(None)
+        return(uris(self.read("r:" + digest)))
+
+    @instruments.timed("redis_seconds", op="flowcache.set")
+    def set(self, trackids, flow, params, order, playlistid=None,
+            snapshotid=None):
+        """
+            Store "order", the sorted list of track URIs, as the result of
+            sorting trackids with flow and params. If the playlist
+            id and snapshot id are given, it can also be found with
+            getsnapshot.
+        """
+        if self.bypass:
+            return
+        digest = resultdigest(trackids, flow, params)
+        # just the ids, which are most of the length of each URI
+        entries = {"r:" + digest:
+                   self.pack([uri.split(":")[-1] for uri in order])}
+        if snapshotid:
+            entries[snapshotkey(playlistid, snapshotid, flow, params)] = \
+                self.pack(digest)
+        self.redis.hmset(self.currentkey, entries)
+        self.rotate()
+
+    @instruments.timed("redis_seconds", op="flowcache.setsnapshot")
+    def setsnapshot(self, trackids, flow, params, playlistid, snapshotid):
+        """
+            Remember that snapshot "snapshotid" of a playlist holds trackids,
+            when its result was found with get rather than computed.
+        """
+        if self.bypass or not snapshotid:
+            return
+        self.redis.hset(self.currentkey,
+                        snapshotkey(playlistid, snapshotid, flow, params),
+                        self.pack(resultdigest(trackids, flow, params)))
+        self.rotate()
+
+    def read(self, key):
+        """
+            Returns the value stored for key, in either hash, or None if it
+            isn't there or is older than ttl.
+        """
+        pipe = self.redis.pipeline()
+        pipe.hget(self.currentkey, key)
+        pipe.hget(self.olderkey, key)
+        for packed in pipe.execute():
+            if packed is None:
+                continue
+            if isinstance(packed, bytes):
+                packed = packed.decode("utf-8")
+            stored, value = json.loads(packed)
+            if time.time() - stored > self.ttl:
+                return(None)
+            return(value)
+        return(None)
+
+    def pack(self, value):
+
+        return(json.dumps([time.time(), value], separators=(",", ":")))
+
+    def rotate(self):
+        """
+            Once the current hash holds half of maxentries, make it the older
+            hash, dropping the previous older one. Only one process does this
+            at a time.
+        """
+        if self.redis.hlen(self.currentkey) < self.maxentries // 2:
+            return
+        if not self.redis.set(self.rotatekey, 1, nx=True, ex=30):
+            return
+        try:
+            if self.redis.hlen(self.currentkey) >= self.maxentries // 2:
+                self.redis.rename(self.currentkey, self.olderkey)
+                # nothing in it can be used after this anyway
+                self.redis.expire(self.olderkey, self.ttl)
+        finally:
+            self.redis.delete(self.rotatekey)
+
+
+def uris(trackids):
+    """
+        Returns a list of track ids as track URIs, or None if given None.
+    """
+    if trackids is None:
+        return(None)
+    return(["spotify:track:{}".format(trackid) for trackid in trackids])
+
+
+def paramsdigest(flow, params):
+    """
+        Returns a hex digest of a flow algorithm's name and parameters.
+    """
+    return(hashlib.sha1(json.dumps([flow, params], sort_keys=True)
+                        .encode("utf-8")).hexdigest())
+
+
+def resultdigest(trackids, flow, params):
+    """
+        Returns a hex digest of a list of track ids, in order, and a flow
+        algorithm's name and parameters.
+    """
+    digest = hashlib.sha1(paramsdigest(flow, params).encode("utf-8"))
+    digest.update("\n".join(trackids).encode("utf-8"))
+    return(digest.hexdigest())
+
+
+def snapshotkey(playlistid, snapshotid, flow, params):
+
+    return("s:{}:{}:{}".format(playlistid, snapshotid,
+                               paramsdigest(flow, params)))
@@ -0,0 +1,157 @@
+# FlowProfile class to choose what "close" means for the flow algorithms
+# A profile is a set of weights for the normalized attributes (one of
+# PROFILES, or a dict overriding some of the default ones), a way to scale
+# each attribute before weighting, and a distance metric:
+#
+#     normalization  "fixed"   each attribute over its usual range (e.g.
+#                              tempo / 180), the same for every playlist
+#                    "minmax"  each attribute over its range in the playlist
+#                    "zscore"  each attribute as standard deviations from its
+#                              mean in the playlist
+#     metric         "euclidean", "manhattan" (the sum of the differences) or
+#                    "cosine" (the angle between the weighted vectors)
+#
+# The profile is compiled once into a weight vector, and applied to a
+# playlist's whole matrix of attribute values (TrackTable.scaled) with a few
+# array operations, giving the matrix the flows sort (see
+# TrackTable.normalize). Cosine distance is made by scaling every row to
+# length one, after which euclidean distance orders tracks exactly as cosine
+# distance does, so it works with every flow. Manhattan distance is used by
+# the flows that compute distances themselves (fastnn, vectornn, fullnn and
+# refinement); the k-d tree based ones only support euclidean distance.
+
+from collections import OrderedDict
+
+import numpy as np
+
+# the normalized attributes, in the order of the columns of the matrix
+ATTRIBUTES = ["danceability", "energy", "mode", "speechiness", "acousticness",
+              "instrumentalness", "liveness", "loudness", "valence", "tempo"]
+
+# weights given to each normalized attribute
+WEIGHTS = np.array([3, # danceability
+                    3, # energy
+                    1, # mode
+                    1, # speechiness
+                    2, # acousticness
+                    1, # instrumentalness
+                    1, # liveness
+                    0.1, # loudness
+                    5, # valence
+                    1, # tempo
+                    ])
+
+PROFILES = OrderedDict([
+    ("default", dict(zip(ATTRIBUTES, WEIGHTS.tolist()))),
+    ("equal", dict((attribute, 1) for attribute in ATTRIBUTES)),
+    # keep the feeling of the playlist steady
+    ("mood", {"danceability": 1, "energy": 4, "mode": 2, "speechiness": 0.5,
+              "acousticness": 2, "instrumentalness": 1, "liveness": 0.5,
+              "loudness": 0.5, "valence": 5, "tempo": 1}),
+    # keep the beat and energy steady, for DJ style mixes
+    ("dance", {"danceability": 5, "energy": 4, "mode": 0.5,
+               "speechiness": 0.5, "acousticness": 1, "instrumentalness": 1,
+               "liveness": 0.5, "loudness": 1, "valence": 2, "tempo": 4}),
+    # group acoustic, instrumental and quiet songs apart from the rest
+    ("acoustic", {"danceability": 1, "energy": 3, "mode": 0.5,
+                  "speechiness": 1, "acousticness": 5, "instrumentalness": 4,
+                  "liveness": 1, "loudness": 2, "valence": 1, "tempo": 1}),
+])
+
+NORMALIZATIONS = ["fixed", "minmax", "zscore"]
+METRICS = ["euclidean", "manhattan", "cosine"]
+
+class FlowProfile():
+
+    def __init__(self, weights="default", normalization="fixed",
+                 metric="euclidean"):
+
+        if isinstance(weights, dict):
+            unknown = set(weights) - set(ATTRIBUTES)
+            if unknown:
+                raise ValueError("unknown attributes {}".format(
+                    ", ".join(sorted(unknown))))
+            values = dict(PROFILES["default"], **weights)
+        elif weights in PROFILES:
+            values = PROFILES[weights]
+        else:
+            raise ValueError("unknown weight profile {}".format(weights))
+        if normalization not in NORMALIZATIONS:
+            raise ValueError("unknown normalization {}".format(normalization))
+        if metric not in METRICS:
+            raise ValueError("unknown metric {}".format(metric))
+
+        self.name = weights if not isinstance(weights, dict) else "custom"
+        self.weights = np.array([float(values[attribute])
+                                 for attribute in ATTRIBUTES])
+        self.normalization = normalization
+        self.metric = metric
+        # what the flows measure the rows of the matrix with
+        self.distance = "manhattan" if metric == "manhattan" else "euclidean"
+
+    def key(self):
+        """
+            Returns a hashable key, equal for profiles giving the same
+            matrix.
+        """
+        return((tuple(self.weights.tolist()), self.normalization,
+                self.metric))
+
+    def params(self):
+        """
+            Returns the profile as a dict of plain values, e.g. for FlowCache.
+        """
+        return({"weights": self.weights.tolist(),
+                "normalization": self.normalization, "metric": self.metric})
+
+    def apply(self, scaled):
+        """
+            Apply the profile to an (n, len(ATTRIBUTES)) matrix of attribute
+            values scaled to their usual ranges (TrackTable.scaled).
+
+            Returns a new (n, len(ATTRIBUTES)) matrix.
+        """
+        matrix = np.array(scaled, dtype=float)
+        if len(matrix) and self.normalization == "minmax":
+            low = np.nanmin(matrix, axis=0)
+            spread = np.nanmax(matrix, axis=0) - low
+            matrix = (matrix - low) / np.where(spread > 0, spread, 1)
+        elif len(matrix) and self.normalization == "zscore":
+            spread = np.nanstd(matrix, axis=0)
+            matrix = ((matrix - np.nanmean(matrix, axis=0))
+                      / np.where(spread > 0, spread, 1))
+        matrix = matrix * self.weights
+        if self.metric == "cosine":
+            lengths = np.sqrt(np.square(matrix).sum(axis=1))
+            matrix = matrix / np.where(lengths > 0, lengths, 1)[:, None]
+        return(matrix)
+
+
+def getprofile(profile=None):
+    """
+        Returns a FlowProfile given one, a dict of FlowProfile arguments (e.g.
+        {"weights": "mood", "metric": "cosine"}), a profile name, or None for
+        the default profile.
+    """
+    if isinstance(profile, FlowProfile):
+        return(profile)
+    if profile is None:
+        return(DEFAULT)
+    if isinstance(profile, dict):
+        return(FlowProfile(**profile))
+    return(FlowProfile(profile))
+
+
+def distances(a, b, metric="euclidean"):
+    """
+        Distances between the rows of a and b (arrays that broadcast
+        together), along their last axis.
+
+        Returns an array of distances.
+    """
+    if metric == "manhattan":
+        return(np.abs(a - b).sum(axis=-1))
+    return(np.sqrt(np.square(a - b).sum(axis=-1)))
+
+
+DEFAULT = FlowProfile()
@@ -0,0 +1,206 @@
+# Instruments class to time the stages of the app and count what they do
+# Timings are kept as histograms (the number of observations at or below
+# each of BUCKETS seconds, their count and their sum) and everything else as
+# counters, in the Prometheus text format's terms, so they can be scraped
+# from the /metrics route of the web process. Every process (web and worker)
+# adds up its own observations in memory and adds them to one redis hash at
+# most every "flushinterval" seconds, with one round trip, so /metrics shows
+# the totals of all of them. Before connect is called (e.g. in benchmark.py)
+# nothing is sent anywhere.
+#
+# The shared instance, "instruments", is what the other modules use:
+#
+#     @instruments.timed("stage_seconds", stage="getuserid")
+#     def getuserid(accesstoken): ...
+#
+#     with instruments.timer("redis_seconds", op="flowcache.get"): ...
+#     instruments.count("spotify_retries_total")
+
+import functools
+import threading
+import time
+import timeit
+from contextlib import contextmanager
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120]
+
+class Instruments():
+
+    def __init__(self, prefix="playlistflow", key="metrics", flushinterval=5):
+
+        self.prefix = prefix # added to the start of every metric name
+        self.key = key
+        self.typeskey = "{}:types".format(key)
+        self.flushinterval = flushinterval
+        self.redis = None
+
+        self.lock = threading.Lock()
+        self.pending = {} # series -> amount to add, since the last flush
+        self.types = {} # metric name -> "histogram" or "counter"
+        self.lastflush = time.time()
+
+    def connect(self, redisconnection):
+        """
+            Start adding this process's metrics to the totals in redis.
+        """
+        self.redis = redisconnection
+
+    def observe(self, name, seconds, **labels):
+        """
+            Add a time (or any other amount) to the histogram "name", with
+            the given labels.
+        """
+        name = self.prefix + "_" + name
+        # every bucket, even if empty, as prometheus expects them all
+        amounts = [(series(name + "_bucket", labels, le=bound),
+                    1 if seconds <= bound else 0) for bound in BUCKETS]
+        amounts.append((series(name + "_bucket", labels, le="+Inf"), 1))
+        amounts.append((series(name + "_sum", labels), seconds))
+        amounts.append((series(name + "_count", labels), 1))
+        self.add(name, "histogram", amounts)
+
+    def count(self, name, amount=1, **labels):
+        """
+            Add amount to the counter "name", with the given labels.
+        """
+        name = self.prefix + "_" + name
+        self.add(name, "counter", [(series(name, labels), amount)])
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+            Context manager that observes how long its block took.
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, timeit.default_timer() - start, **labels)
+
+    def timed(self, name, **labels):
+        """
+            Decorator that observes how long each call of a function took.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return(f(*args, **kwargs))
+            return(wrapper)
+        return(decorator)
+
+    def add(self, name, kind, amounts):
+
+        with self.lock:
+            self.types[name] = kind
+            for key, amount in amounts:
+                self.pending[key] = self.pending.get(key, 0) + amount
+            due = (self.redis is not None
+                   and time.time() - self.lastflush >= self.flushinterval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+            Add everything observed since the last flush to the totals in
+            redis. If that fails it's kept for the next one.
+        """
+        if self.redis is None:
+            return
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            types = dict(self.types)
+            self.lastflush = time.time()
+        if not pending:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, amount in pending.items():
+                pipe.hincrbyfloat(self.key, key, amount)
+            pipe.hmset(self.typeskey, types)
+            pipe.execute()
+        except Exception as e:
+            print('error: could not save metrics: {}'.format(e))
+            with self.lock:
+                for key, amount in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + amount
+
+    def render(self):
+        """
+            Returns the totals of every process, after flushing this one's,
+            in the Prometheus text exposition format.
+        """
+        self.flush()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.key)
+        pipe.hgetall(self.typeskey)
+        totals, types = pipe.execute()
+        totals = dict((decode(key), float(value))
+                      for key, value in totals.items())
+        types = dict((decode(key), decode(value))
+                     for key, value in types.items())
+
+        lines = []
+        for name in sorted(types):
+            lines.append("# TYPE {} {}".format(name, types[name]))
+            names = [name]
+            if types[name] == "histogram":
+                names = [name + "_bucket", name + "_sum", name + "_count"]
+            keys = [key for key in totals if key.split("{")[0] in names]
+            for key in sorted(keys, key=sortkey):
+                lines.append("{} {}".format(key, number(totals[key])))
+        return("\n".join(lines) + "\n")
+
+
+def series(name, labels, **extra):
+    """
+        Returns the name of a series with its labels, as it is written in
+        the Prometheus text format, e.g. 'stage_seconds{stage="getuserid"}'.
+    """
+    labels = dict(labels, **extra)
+    if not labels:
+        return(name)
+    return("{}{{{}}}".format(name, ",".join(
+        '{}="{}"'.format(label, str(labels[label]).replace("\\", "\\\\")
+                         .replace('"', '\\"'))
+        for label in sorted(labels))))
+
+
+def sortkey(key):
+    """
+        Orders series by name and labels, with histogram buckets in
+        increasing order.
+    """
+    name, _, labels = key.partition("{")
+    le = None
+    rest = []
+    for label in labels.rstrip("}").split(","):
+        if label.startswith('le="'):
+            le = label[4:-1]
+        else:
+            rest.append(label)
+    bound = float("inf") if le in (None, "+Inf") else float(le)
+    suffix = name.rsplit("_", 1)[-1]
+    return(name.rsplit("_", 1)[0], rest, suffix, bound)
+
+
+def number(value):
+
+    if value == int(value):
+        return(str(int(value)))
+    return(repr(value))
+
+
+def decode(value):
+    """
+        Returns a value read from redis as text.
+    """
+    if isinstance(value, bytes):
+        return(value.decode("utf-8"))
+    return(value)
+
+
+# shared by every module of the app (see connect)
+instruments = Instruments()
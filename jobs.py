@@ -0,0 +1,268 @@
+# JobQueue class to hand work from the web process to worker processes
+# A job is a small JSON payload pushed onto a redis list. Workers move it onto
+# a "processing" list while they run it (with BRPOPLPUSH, so a job is never
+# lost between being taken off the queue and being worked on), and each job's
+# status, attempts and result are kept in a hash readable by the web process.
+#
+# Jobs that fail are put back on the queue until they have been tried
+# "maxattempts" times. While a job runs, its worker updates the job's
+# "updated" time every "timeout" / 10 seconds, and jobs left on the processing
+# list by a worker that died are put back once "updated" is "timeout" seconds
+# old. Jobs enqueued with a dedup key that is still held by an unfinished (or
+# recently finished) job aren't added again; the id of the existing job is
+# returned.
+
+import json
+import random
+import string
+import threading
+import time
+import traceback
+
+from instrument import instruments
+
+class JobFailed(Exception):
+    """
+        Raised by a job handler when a job can't be completed. If "retry" is
+        False the job is marked failed straight away instead of being tried
+        again.
+    """
+
+    def __init__(self, message, retry=True):
+
+        Exception.__init__(self, message)
+        self.retry = retry
+
+
+class JobQueue():
+
+    def __init__(self, redisconnection, name="jobs", maxattempts=3,
+                 timeout=600, jobttl=86400, dedupttl=300):
+
+        self.redis = redisconnection
+        self.maxattempts = maxattempts
+        self.timeout = timeout # seconds without a heartbeat before a retry
+        self.jobttl = jobttl # seconds a finished job's status is kept
+        self.dedupttl = dedupttl # seconds a finished job still holds its key
+        self.queuekey = "{}:queue".format(name)
+        self.processingkey = "{}:processing".format(name)
+        self.jobprefix = "{}:job:".format(name)
+        self.dedupprefix = "{}:dedup:".format(name)
+
+    @instruments.timed("redis_seconds", op="jobs.enqueue")
+    def enqueue(self, payload, dedupkey=None):
+        """
+            Add a job with the given payload (a dict that can be stored as
+            JSON) to the end of the queue, unless a job with the same dedup
+            key is already queued, running or just finished.
+
+            Returns the job id.
+        """
+        jobid = ''.join(random.choice(string.ascii_lowercase + string.digits)
+                        for i in range(16))
+
+        if dedupkey is not None:
+            key = self.dedupprefix + dedupkey
+            if not self.redis.set(key, jobid, nx=True, ex=self.timeout
+                                  * self.maxattempts + self.dedupttl):
+                existing = decode(self.redis.get(key))
+                if existing and self.status(existing):
+                    return(existing)
+                self.redis.set(key, jobid, ex=self.timeout * self.maxattempts
+                               + self.dedupttl)
+
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.jobprefix + jobid,
+                   {"status": "queued",
+                    "payload": json.dumps(payload),
+                    "dedupkey": dedupkey or "",
+                    "attempts": 0,
+                    "created": now,
+                    "updated": now})
+        pipe.expire(self.jobprefix + jobid, self.jobttl)
+        pipe.lpush(self.queuekey, jobid)
+        pipe.execute()
+        return(jobid)
+
+    def reserve(self, wait=5):
+        """
+            Take the job at the front of the queue, waiting up to "wait"
+            seconds for one, and mark it running.
+
+            Returns (job id, payload), or (None, None) if there is no job.
+        """
+        jobid = decode(self.redis.brpoplpush(self.queuekey, self.processingkey,
+                                             wait))
+        if jobid is None:
+            return(None, None)
+
+        job = self.status(jobid)
+        if not job:
+            # expired while it waited; nothing left to run
+            self.removeprocessing(jobid)
+            return(None, None)
+
+        self.redis.hmset(self.jobprefix + jobid, {"status": "running",
+                                                  "started": time.time(),
+                                                  "updated": time.time()})
+        self.redis.hincrby(self.jobprefix + jobid, "attempts", 1)
+        return(jobid, json.loads(job["payload"]))
+
+    def complete(self, jobid, result):
+        """
+            Mark a job done, storing result (a dict that can be stored as
+            JSON) for status to return.
+        """
+        self.finish(jobid, {"status": "done", "result": json.dumps(result)})
+
+    def fail(self, jobid, error, retry=True):
+        """
+            Record that a run of a job failed with message "error". The job
+            goes back on the queue if it's worth retrying and hasn't used up
+            its attempts, otherwise it's marked failed.
+        """
+        job = self.status(jobid)
+        if not job:
+            self.removeprocessing(jobid)
+            return
+        if retry and int(job["attempts"]) < self.maxattempts:
+            self.redis.hmset(self.jobprefix + jobid, {"status": "queued",
+                                                      "error": error,
+                                                      "updated": time.time()})
+            if self.removeprocessing(jobid):
+                self.redis.lpush(self.queuekey, jobid)
+            return
+        self.finish(jobid, {"status": "failed", "error": error})
+        if job["dedupkey"]:
+            # let the same work be asked for again straight away
+            self.redis.delete(self.dedupprefix + job["dedupkey"])
+
+    def finish(self, jobid, fields):
+
+        fields["updated"] = time.time()
+        job = self.status(jobid)
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.jobprefix + jobid, fields)
+        pipe.expire(self.jobprefix + jobid, self.jobttl)
+        if job and job["dedupkey"]:
+            pipe.expire(self.dedupprefix + job["dedupkey"], self.dedupttl)
+        pipe.execute()
+        self.removeprocessing(jobid)
+
+    def removeprocessing(self, jobid):
+        """
+            Take a job off the processing list.
+
+            Returns True if it was there.
+        """
+        # LREM takes its arguments in a different order in the Redis and
+        # StrictRedis clients of older redis-py versions
+        return(bool(self.redis.execute_command("LREM", self.processingkey, 0,
+                                               jobid)))
+
+    def requeuestale(self):
+        """
+            Put jobs that haven't had a heartbeat for "timeout" seconds
+            (most likely because their worker died) back on the queue, or
+            mark them failed if they have used up their attempts.
+
+            Returns the number of jobs found.
+        """
+        stale = 0
+        for jobid in self.redis.lrange(self.processingkey, 0, -1):
+            jobid = decode(jobid)
+            job = self.status(jobid)
+            if not job:
+                self.removeprocessing(jobid)
+                continue
+            if (job["status"] in ("queued", "running")
+                    and time.time() - float(job["updated"]) > self.timeout):
+                stale = stale + 1
+                self.fail(jobid, "timed out")
+        return(stale)
+
+    def heartbeat(self, jobid, dedupkey=None):
+        """
+            Record that a running job is still being worked on, so that it
+            isn't taken for the job of a dead worker, and keep its dedup key.
+        """
+        pipe = self.redis.pipeline()
+        pipe.hset(self.jobprefix + jobid, "updated", time.time())
+        if dedupkey:
+            pipe.expire(self.dedupprefix + dedupkey,
+                        self.timeout * self.maxattempts + self.dedupttl)
+        pipe.execute()
+
+    def beat(self, jobid, stop):
+        """
+            Call heartbeat for a job every "timeout" / 10 seconds until stop
+            (a threading.Event) is set.
+        """
+        job = self.status(jobid) or {}
+        while not stop.wait(self.timeout / 10.0):
+            try:
+                self.heartbeat(jobid, job.get("dedupkey"))
+            except Exception as e:
+                print('error: heartbeat of job {} failed: {}'.format(jobid, e))
+
+    @instruments.timed("redis_seconds", op="jobs.status")
+    def status(self, jobid):
+        """
+            Returns a dict of the fields of a job ("status" is one of
+            "queued", "running", "done" or "failed"; "result" is decoded from
+            JSON), or None if there is no such job.
+        """
+        fields = self.redis.hgetall(self.jobprefix + jobid)
+        if not fields:
+            return(None)
+        job = dict((decode(name), decode(value))
+                   for name, value in fields.items())
+        if "result" in job:
+            job["result"] = json.loads(job["result"])
+        return(job)
+
+    def work(self, handler, wait=5):
+        """
+            Run jobs forever, calling handler with each job's payload. The
+            handler returns the job's result, or raises JobFailed (or any
+            other exception, which is retried) if it can't complete the job.
+        """
+        lastcheck = 0
+        while True:
+            if time.time() - lastcheck > self.timeout / 10.0:
+                self.requeuestale()
+                lastcheck = time.time()
+
+            jobid, payload = self.reserve(wait)
+            if jobid is None:
+                continue
+
+            stop = threading.Event()
+            beat = threading.Thread(target=self.beat, args=(jobid, stop))
+            beat.daemon = True
+            beat.start()
+            try:
+                result = handler(payload)
+            except JobFailed as e:
+                print('job {} failed: {}'.format(jobid, e))
+                self.fail(jobid, str(e), e.retry)
+                continue
+            except Exception as e:
+                print('job {} failed: {}'.format(jobid, e))
+                traceback.print_exc()
+                self.fail(jobid, str(e))
+                continue
+            finally:
+                stop.set()
+            self.complete(jobid, result)
+
+
+def decode(value):
+    """
+        Returns a value read from redis as a string (python 3 clients return
+        bytes).
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return(value.decode("utf-8"))
+    return(value)
@@ -0,0 +1,149 @@
+# KDTree class for nearest neighbor lookups over track feature vectors
+# Built once over the rows of a feature matrix (see sort.featurematrix).
+# Answers "closest k rows" queries and supports removing rows, so the nearest
+# neighbor walk can ask for the closest unvisited track without scanning every
+# track at each step.
+
+import numpy as np
+
+class KDTree():
+
+    def __init__(self, matrix, leafsize=64):
+
+        matrix = np.asarray(matrix, dtype=float)
+        n = len(matrix)
+
+        self.leafsize = leafsize
+        self.alive = np.ones(n, dtype=bool) # rows that have not been removed
+        self.count = n # number of rows not yet removed
+
+        # per node arrays, filled in by build. a node covers the rows
+        # self.perm[lo:hi]; leaves have splitdim == -1
+        self.lo = []
+        self.hi = []
+        self.splitdim = []
+        self.splitval = []
+        self.left = []
+        self.right = []
+        self.parent = []
+        self.nodecount = [] # rows not yet removed below each node
+
+        self.perm = np.arange(n)
+        self.leafof = np.zeros(n, dtype=int) # leaf node holding each row
+        if n:
+            self.build(matrix)
+
+        # rows in tree order, so each leaf's rows are one contiguous slice
+        self.points = matrix[self.perm]
+
+    def __len__(self):
+
+        return(self.count)
+
+    def build(self, matrix):
+        """
+            Split nodes at the median of the dimension with the largest spread
+            until every leaf holds at most leafsize rows.
+        """
+        self.addnode(0, len(matrix), -1)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            lo, hi = self.lo[node], self.hi[node]
+            rows = self.perm[lo:hi]
+
+            if hi - lo <= self.leafsize:
+                self.leafof[rows] = node
+                continue
+
+            values = matrix[rows]
+            dim = int(np.argmax(values.max(axis=0) - values.min(axis=0)))
+            mid = (hi - lo) // 2
+            split = np.argpartition(values[:, dim], mid)
+            self.perm[lo:hi] = rows[split]
+
+            self.splitdim[node] = dim
+            self.splitval[node] = float(values[split[mid], dim])
+            self.left[node] = self.addnode(lo, lo + mid, node)
+            self.right[node] = self.addnode(lo + mid, hi, node)
+            stack.append(self.left[node])
+            stack.append(self.right[node])
+
+    def addnode(self, lo, hi, parent):
+
+        self.lo.append(lo)
+        self.hi.append(hi)
+        self.splitdim.append(-1)
+        self.splitval.append(0.0)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.parent.append(parent)
+        self.nodecount.append(hi - lo)
+        return(len(self.lo) - 1)
+
+    def remove(self, index):
+        """
+            Remove the row "index" from the tree so later queries skip it.
+        """
+        if not self.alive[index]:
+            return
+        self.alive[index] = False
+        self.count = self.count - 1
+        node = self.leafof[index]
+        while node != -1:
+            self.nodecount[node] = self.nodecount[node] - 1
+            node = self.parent[node]
+
+    def query(self, point, k=1):
+        """
+            Find the k rows closest to point (by Euclidean distance) that have
+            not been removed. Ties between equal distances go to the lowest
+            row index, the same as a linear scan would.
+
+            Returns a list of row indices, closest first.
+        """
+        if not self.count:
+            return([])
+        point = np.asarray(point, dtype=float)
+        best = [] # sorted list of (squared distance, row index)
+        offsets = [0.0] * len(point)
+        self.search(0, 0.0, offsets, point, point.tolist(), k, best)
+        return([index for distance, index in best])
+
+    def search(self, node, bound, offsets, point, coords, k, best):
+        """
+            Depth-first search below node. "bound" is a lower bound on the
+            squared distance from point to anything in the node, built up
+            from the per-dimension offsets to the splitting planes crossed so
+            far. "coords" is point as a plain list, which is quicker to index
+            one value at a time.
+        """
+        if not self.nodecount[node]:
+            return
+        if len(best) == k and bound > best[-1][0]:
+            return
+
+        dim = self.splitdim[node]
+        if dim == -1:
+            lo, hi = self.lo[node], self.hi[node]
+            rows = self.perm[lo:hi]
+            distances = np.square(self.points[lo:hi] - point).sum(axis=1)
+            mask = self.alive[rows]
+            candidates = zip(distances[mask].tolist(), rows[mask].tolist())
+            best[:] = sorted(best + list(candidates))[:k]
+            return
+
+        diff = coords[dim] - self.splitval[node]
+        if diff < 0:
+            near, far = self.left[node], self.right[node]
+        else:
+            near, far = self.right[node], self.left[node]
+
+        self.search(near, bound, offsets, point, coords, k, best)
+
+        old = offsets[dim]
+        farbound = bound - old * old + diff * diff
+        if len(best) < k or farbound <= best[-1][0]:
+            offsets[dim] = diff
+            self.search(far, farbound, offsets, point, coords, k, best)
+            offsets[dim] = old
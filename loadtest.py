@@ -0,0 +1,194 @@
+# Load test for the web app: simulated users log in, list their playlists
+# and flow one, as many at once as asked, and the time each route took is
+# reported as throughput and p50/p95/p99 latency per route. Meant to be run
+# against the app with its spotify requests going to mockspotify.py:
+#
+#     python mockspotify.py --port 5001 --latency 0.05
+#     SPOTIFY_API_URL=http://localhost:5001 \
+#     SPOTIFY_ACCOUNTS_URL=http://localhost:5001 \
+#     REDIRECTURI=http://localhost:5000/callback python playlistflow.py
+#     (and a worker, with the same environment)
+#     python loadtest.py --app http://localhost:5000 --users 200 \
+#         --concurrency 20
+#
+# Each user goes /spotifylogin -> (spotify's login) -> /callback ->
+# /playlists -> /selection, then polls /status until their playlist is done.
+# "flow" in the report is the time from /selection to the finished playlist.
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import timeit
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import requests
+
+ROUTES = ["/spotifylogin", "/callback", "/playlists", "/selection", "/status",
+          "flow"]
+
+class Recorder():
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.times = dict((route, []) for route in ROUTES)
+        self.errors = dict((route, 0) for route in ROUTES)
+
+    def add(self, route, seconds, ok=True):
+
+        with self.lock:
+            self.times[route].append(seconds)
+            if not ok:
+                self.errors[route] = self.errors[route] + 1
+
+    def report(self, elapsed):
+        """
+            Returns a dict of the number of requests, errors, requests per
+            second and latency percentiles of each route.
+        """
+        report = OrderedDict()
+        for route in ROUTES:
+            times = self.times[route]
+            result = OrderedDict()
+            result["count"] = len(times)
+            result["errors"] = self.errors[route]
+            result["persecond"] = len(times) / elapsed if elapsed else 0.0
+            for p in (50, 95, 99):
+                result["p{}".format(p)] = \
+                    float(np.percentile(times, p)) if times else None
+            report[route] = result
+        return(report)
+
+def timed(recorder, route, session, url, ok, **kwargs):
+    """
+        GET url with session, without following redirects, and record how
+        long it took under route. ok(response) says whether it worked.
+
+        Returns the response, or None if the request failed.
+    """
+    start = timeit.default_timer()
+    try:
+        response = session.get(url, allow_redirects=False, **kwargs)
+    except requests.exceptions.RequestException:
+        recorder.add(route, timeit.default_timer() - start, False)
+        return(None)
+    worked = ok(response)
+    recorder.add(route, timeit.default_timer() - start, worked)
+    return(response if worked else None)
+
+def simulateuser(app, recorder, poll=0.5, timeout=300):
+    """
+        Take one user through logging in and flowing a random playlist.
+
+        Returns True if the flowed playlist was made, False otherwise.
+    """
+    session = requests.Session()
+    redirected = lambda r: r.status_code in (301, 302, 303, 307)
+    html = lambda r: r.status_code == 200 and not r.text.startswith("error")
+
+    r = timed(recorder, "/spotifylogin", session, app + "/spotifylogin",
+              redirected)
+    if r is None:
+        return(False)
+    # the login page, which the mock skips straight past
+    try:
+        r = session.get(r.headers["Location"], allow_redirects=False)
+    except requests.exceptions.RequestException:
+        return(False)
+    if not redirected(r):
+        return(False)
+    if timed(recorder, "/callback", session, r.headers["Location"],
+             html) is None:
+        return(False)
+
+    r = timed(recorder, "/playlists", session, app + "/playlists",
+              lambda r: r.status_code == 200, params={"offset": 0})
+    if r is None or not r.json()["names"]:
+        return(False)
+    choice = random.choice(r.json()["names"])
+
+    r = timed(recorder, "/selection", session, app + "/selection", html,
+              params={"choice": choice})
+    if r is None:
+        return(False)
+    start = timeit.default_timer()
+    match = re.search(r"/status/([^\"]+)\"", r.text)
+    if match is None:
+        recorder.add("flow", timeit.default_timer() - start, False)
+        return(False)
+
+    status = "unknown"
+    while timeit.default_timer() - start < timeout:
+        r = timed(recorder, "/status", session,
+                  app + "/status/" + match.group(1),
+                  lambda r: r.status_code == 200)
+        status = r.json()["status"] if r is not None else "unknown"
+        if status in ("done", "failed"):
+            break
+        time.sleep(poll)
+    recorder.add("flow", timeit.default_timer() - start, status == "done")
+    return(status == "done")
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Run simulated users through the web app.")
+    parser.add_argument("--app", default="http://localhost:5000",
+                        help="URL of the web app")
+    parser.add_argument("--users", type=int, default=50,
+                        help="simulated users in all")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="simulated users at once")
+    parser.add_argument("--poll", type=float, default=0.5,
+                        help="seconds between /status requests")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds to wait for each flowed playlist")
+    parser.add_argument("--output", help="also write the report as JSON here")
+    args = parser.parse_args(argv)
+
+    app = args.app.rstrip("/")
+    recorder = Recorder()
+
+    def run(i):
+        return(simulateuser(app, recorder, args.poll, args.timeout))
+
+    pool = ThreadPool(args.concurrency)
+    start = timeit.default_timer()
+    try:
+        results = pool.map(run, range(args.users))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = timeit.default_timer() - start
+
+    report = OrderedDict()
+    report["users"] = args.users
+    report["concurrency"] = args.concurrency
+    report["completed"] = sum(1 for result in results if result)
+    report["seconds"] = elapsed
+    report["routes"] = recorder.report(elapsed)
+
+    print("{} of {} users got a flowed playlist in {:.1f}s".format(
+        report["completed"], args.users, elapsed))
+    print("{:<14} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8}".format(
+        "route", "count", "errors", "per sec", "p50", "p95", "p99"))
+    for route, result in report["routes"].items():
+        if not result["count"]:
+            continue
+        print("{:<14} {:>7} {:>7} {:>8.2f} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+            route, result["count"], result["errors"], result["persecond"],
+            result["p50"], result["p95"], result["p99"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+    return(0 if report["completed"] == args.users else 1)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,346 @@
+# Local search refinement for flow orderings
+# Takes an ordering produced by one of the flows in sort.py and improves it
+# with 2-opt (reverse a stretch of the playlist) and Or-opt (move a run of 1-3
+# songs somewhere else) moves. Moves are only considered between each track
+# and its closest few neighbors, and the gains for a whole pass are computed
+# at once with numpy, so a pass is close to linear in the number of tracks.
+#
+# The open playlist is handled as a closed tour with an extra "dummy" stop at
+# zero distance from every track; the playlist is the tour read from just
+# after the dummy stop. Distances are euclidean or manhattan, as the flow
+# profile says, but the candidate neighbors are always the closest by
+# euclidean distance, which are close enough for picking moves to try.
+
+import math
+import time
+
+import numpy as np
+
+import sort
+from flowprofiles import distances, getprofile
+
+def refine(tracks, neighbors=8, timelimit=None, maxpasses=50, profile=None):
+    """
+        Improve the order of a list of tracks (e.g. the output of simpleflow,
+        fastnnflow or fullnnflow) with 2-opt and Or-opt moves. Stops when a
+        full pass finds nothing to improve, after "maxpasses" passes, or once
+        "timelimit" seconds have gone by (counting the setup), whichever
+        comes first. Distances are measured as "profile" (a FlowProfile, or
+        anything getprofile takes) says.
+
+        Returns a list of the same tracks in the improved order.
+    """
+    if len(tracks) < 4:
+        return(list(tracks))
+    started = time.time()
+    profile = getprofile(profile)
+    matrix = sort.featurematrix(tracks, profile)
+    if timelimit is not None:
+        timelimit = timelimit - (time.time() - started)
+    order = refineorder(matrix, range(len(tracks)), neighbors, timelimit,
+                        maxpasses, profile.distance)
+    return([tracks[i] for i in order])
+
+
+def refineorder(matrix, order, neighbors=8, timelimit=None, maxpasses=50,
+                metric="euclidean"):
+    """
+        Improve an ordering of the rows of a feature matrix (a list of row
+        indices) with 2-opt and Or-opt moves, measuring distances by "metric"
+        ("euclidean" or "manhattan"). See refine.
+
+        Returns a list of row indices.
+    """
+    n = len(matrix)
+    if n < 4:
+        return(list(order))
+    if timelimit is not None:
+        deadline = time.time() + timelimit
+    else:
+        deadline = None
+
+    tour = Tour(matrix, order, neighbors, metric, deadline)
+    if deadline and time.time() > deadline:
+        return(list(order))
+
+    for i in range(maxpasses):
+        improved = tour.twooptpass(deadline)
+        for length in (1, 2, 3):
+            improved = tour.oroptpass(length, deadline) or improved
+        if not improved or (deadline and time.time() > deadline):
+            break
+
+    return(tour.order())
+
+
+def ordercandidates(matrix, order, k, window=16):
+    """
+        Quick stand-in for sort.neighborlists when there isn't time for it:
+        the k closest rows to each row of a feature matrix among the
+        "window" rows either side of it in an ordering (a list of row
+        indices) that already flows, such as one of the flows in sort.py.
+        O(n * window).
+
+        Returns an (n, k) array of row indices, closest first.
+    """
+    order = np.asarray(order, dtype=int)
+    n = len(order)
+    window = max(1, min(window, (n - 1) // 2))
+    k = min(k, 2 * window)
+
+    # rows up to "window" places away in the ordering, wrapping around the
+    # ends
+    offsets = np.concatenate([np.arange(-window, 0), np.arange(1, window + 1)])
+    nearby = np.empty((n, len(offsets)), dtype=int)
+    nearby[order] = order[(np.arange(n)[:, None] + offsets[None, :]) % n]
+    gaps = np.square(matrix[nearby] - matrix[:, None, :]).sum(axis=2)
+
+    closest = np.argsort(gaps, axis=1, kind="mergesort")[:, :k]
+    return(nearby[np.arange(n)[:, None], closest])
+
+
+class Tour():
+
+    def __init__(self, matrix, order, neighbors, metric="euclidean",
+                 deadline=None):
+
+        n = len(matrix)
+        self.metric = metric
+        self.dummy = n
+        self.size = n + 1
+
+        # feature matrix with a row for the dummy stop, and the same values
+        # as plain lists for quicker one-off distances
+        self.points = np.vstack([matrix, np.zeros((1, matrix.shape[1]))])
+        self.rows = self.points.tolist()
+
+        self.tour = np.append(np.asarray(list(order), dtype=int), self.dummy)
+        self.pos = np.empty(self.size, dtype=int)
+        self.pos[self.tour] = np.arange(self.size)
+
+        # each track's candidate neighbors, plus the dummy stop so that moves
+        # can also make a track the start or end of the playlist. finding the
+        # closest tracks takes time quadratic in n, so if that would use up
+        # more than half of the time left, the closest tracks near each one
+        # in the starting order are taken instead
+        closest = None
+        if deadline is None:
+            closest = sort.neighborlists(matrix, neighbors)
+        elif deadline > time.time():
+            closest = sort.neighborlists(
+                matrix, neighbors,
+                deadline=time.time() + (deadline - time.time()) / 2)
+        if closest is None:
+            closest = ordercandidates(matrix, self.tour[:-1], neighbors)
+        self.candidates = np.hstack([closest,
+                                     np.full((n, 1), self.dummy, dtype=int)])
+        self.candidatedistances = self.distance(np.arange(n)[:, None],
+                                                self.candidates)
+
+    def order(self):
+        """
+            Returns the tour as a list of row indices, starting after the
+            dummy stop.
+        """
+        start = self.pos[self.dummy]
+        return(np.concatenate([self.tour[start + 1:],
+                               self.tour[:start]]).tolist())
+
+    def distance(self, a, b):
+        """
+            Distance between (arrays of) stops a and b. Anything to or from the
+            dummy stop is 0.
+        """
+        if np.isscalar(a) and np.isscalar(b):
+            if a == self.dummy or b == self.dummy:
+                return(0.0)
+            if self.metric == "manhattan":
+                return(sum([abs(x - y) for x, y
+                            in zip(self.rows[a], self.rows[b])]))
+            return(math.sqrt(sum([(x - y) * (x - y) for x, y
+                                  in zip(self.rows[a], self.rows[b])])))
+        a = np.asarray(a)
+        b = np.asarray(b)
+        result = distances(self.points[a], self.points[b], self.metric)
+        return(np.where((a == self.dummy) | (b == self.dummy), 0.0, result))
+
+    def nextdistances(self):
+        """
+            Returns an array with the distance from each stop to the one after
+            it in the tour.
+        """
+        result = np.empty(self.size)
+        result[self.tour] = self.distance(self.tour, np.roll(self.tour, -1))
+        return(result)
+
+    def succ(self, a):
+
+        return(self.tour[(self.pos[a] + 1) % self.size])
+
+    def pred(self, a):
+
+        return(self.tour[(self.pos[a] - 1) % self.size])
+
+    def twooptgain(self, a, c):
+        """
+            Gain from replacing edges (a, succ a) and (c, succ c) with (a, c)
+            and (succ a, succ c).
+        """
+        b = self.succ(a)
+        d = self.succ(c)
+        return(self.distance(a, b) + self.distance(c, d)
+               - self.distance(a, c) - self.distance(b, d))
+
+    def twooptpass(self, deadline=None):
+        """
+            Evaluate every 2-opt move between a track and its candidate
+            neighbors at once, then apply the improving ones, best first,
+            re-checking each against the tour as it stands.
+
+            Returns True if any move was applied.
+        """
+        if deadline and time.time() > deadline:
+            return(False)
+        a = np.arange(self.dummy)[:, None]
+        c = self.candidates
+        nextdist = self.nextdistances()
+
+        # join each track to its neighbor, either after the two tracks that
+        # currently follow them or before the two that currently precede them
+        pa = self.pred(a)
+        pc = self.pred(c)
+        after = (nextdist[a] + nextdist[c] - self.candidatedistances
+                 - self.distance(self.succ(a), self.succ(c)))
+        before = (nextdist[pa] + nextdist[pc] - self.candidatedistances
+                  - self.distance(pa, pc))
+
+        moves = []
+        for gains, first, second in ((after, a, c), (before, pa, pc)):
+            rows, cols = np.nonzero(gains > 1e-9)
+            first = np.broadcast_to(first, c.shape)
+            moves.extend(zip(gains[rows, cols].tolist(),
+                             first[rows, cols].tolist(),
+                             second[rows, cols].tolist()))
+        moves.sort(reverse=True)
+
+        improved = False
+        for gain, x, y in moves:
+            if deadline and time.time() > deadline:
+                break
+            if x == y or self.twooptgain(x, y) <= 1e-9:
+                continue
+            self.twooptmove(x, y)
+            improved = True
+        return(improved)
+
+    def twooptmove(self, a, c):
+        """
+            Reconnect the tour with edges (a, c) and (succ a, succ c) by
+            reversing whichever of the two stretches between them is shorter.
+        """
+        i = self.pos[a]
+        j = self.pos[c]
+        if i > j:
+            i, j = j, i
+        # reversing positions i+1..j, or the rest of the tour, give the same
+        # cycle
+        if j - i > self.size // 2:
+            positions = np.arange(j + 1, i + 1 + self.size) % self.size
+        else:
+            positions = np.arange(i + 1, j + 1)
+        self.tour[positions] = self.tour[positions[::-1]]
+        self.pos[self.tour[positions]] = positions
+
+    def oroptpass(self, length, deadline=None):
+        """
+            Evaluate moving every run of "length" consecutive tracks next to
+            one of the candidate neighbors of its first or last track, in
+            either direction, then apply the improving moves best first.
+
+            Returns True if any move was applied.
+        """
+        if deadline and time.time() > deadline:
+            return(False)
+        starts = np.arange(self.size)
+        segments = (starts[:, None] + np.arange(length)) % self.size
+        segments = self.tour[segments]
+        # runs containing the dummy stop stay put
+        segments = segments[~(segments == self.dummy).any(axis=1)]
+        if not len(segments):
+            return(False)
+
+        first = segments[:, :1]
+        last = segments[:, -1:]
+        nextdist = self.nextdistances()
+        before = self.pred(first)
+        removegain = (nextdist[before] + nextdist[last]
+                      - self.distance(before, self.succ(last)))
+
+        moves = []
+        for reverse, near, far in ((False, first, last), (True, last, first)):
+            # the near end of the run goes next to c, the far end next to
+            # the stop after c
+            c = self.candidates[near[:, 0]]
+            insertcost = (self.candidatedistances[near[:, 0]]
+                          + self.distance(far, self.succ(c)) - nextdist[c])
+            gains = removegain - insertcost
+            offsets = (self.pos[c] - self.pos[first]) % self.size
+            valid = (offsets >= length) & (c != before)
+            rows, cols = np.nonzero(valid & (gains > 1e-9))
+            moves.extend(zip(gains[rows, cols].tolist(),
+                             first[rows, 0].tolist(),
+                             c[rows, cols].tolist(),
+                             [reverse] * len(rows)))
+        moves.sort(reverse=True)
+
+        improved = False
+        for gain, start, c, reverse in moves:
+            if deadline and time.time() > deadline:
+                break
+            positions = (self.pos[start] + np.arange(length)) % self.size
+            segment = self.tour[positions]
+            if (self.dummy in segment or c in segment
+                    or c == self.pred(start)):
+                continue
+            gain = (self.oroptremovegain(segment[0], segment[-1])
+                    - self.oroptinsertcost(segment[0], segment[-1], c, reverse))
+            if gain <= 1e-9:
+                continue
+            self.oroptmove(positions, c, reverse)
+            improved = True
+        return(improved)
+
+    def oroptremovegain(self, first, last):
+        """
+            Length saved by taking the run first..last out of the tour and
+            joining its neighbors.
+        """
+        before = self.pred(first)
+        after = self.succ(last)
+        return(self.distance(before, first) + self.distance(last, after)
+               - self.distance(before, after))
+
+    def oroptinsertcost(self, first, last, c, reverse):
+        """
+            Length added by putting the run first..last between c and succ c,
+            reversed if "reverse" is set.
+        """
+        e = self.succ(c)
+        if reverse:
+            first, last = last, first
+        return(self.distance(c, first) + self.distance(last, e)
+               - self.distance(c, e))
+
+    def oroptmove(self, positions, c, reverse):
+        """
+            Move the tracks at "positions" to just after c.
+        """
+        segment = self.tour[positions]
+        if reverse:
+            segment = segment[::-1]
+        # the rest of the tour, starting just after the run
+        rest = self.tour[(positions[-1] + 1 + np.arange(self.size - len(positions)))
+                         % self.size]
+        insert = int(np.flatnonzero(rest == c)[0]) + 1
+        self.tour = np.concatenate([rest[:insert], segment, rest[insert:]])
+        self.pos[self.tour] = np.arange(self.size)
@@ -0,0 +1,72 @@
+# Flow quality metrics
+# Measures how smoothly an ordering of tracks flows from each song to the
+# next, from the same normalized attribute matrix the flow algorithms use
+# (see sort.featurematrix), all in one pass with numpy. Used by benchmark.py
+# and, when turned on, logged by the worker for each playlist it flows.
+
+import numpy as np
+
+import sort
+from flowprofiles import ATTRIBUTES, distances, getprofile
+
+PERCENTILES = [50, 90, 95, 99]
+
+def flowmetrics(tracks, profile=None):
+    """
+        Measure the flow of a list of tracks in the order given, with
+        distances as "profile" (a FlowProfile, or anything getprofile takes)
+        says. See ordermetrics.
+
+        Returns a dict of metrics.
+    """
+    profile = getprofile(profile)
+    return(ordermetrics(sort.featurematrix(tracks, profile),
+                        metric=profile.distance))
+
+
+def ordermetrics(matrix, order=None, metric="euclidean"):
+    """
+        Measure the flow of the rows of a normalized attribute matrix, in the
+        order given as a list of row indices (or as they are), by "metric"
+        ("euclidean" or "manhattan"). The metrics are:
+
+        "total", "mean" and "max": the sum, mean and largest of the
+        distances between each track and the next (the "jumps"), "p50",
+        "p90", ... : percentiles of the jumps, and "smoothness": for each
+        attribute, the mean change from each track to the next divided by
+        the mean change between two tracks picked at random, so 0 means the
+        attribute never changes and around 1 means it changes as much as in
+        a shuffled playlist.
+
+        Returns a dict of metrics.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    if order is not None:
+        matrix = matrix[np.asarray(order, dtype=int)]
+    n = len(matrix)
+
+    steps = np.abs(np.diff(matrix, axis=0))
+    jumps = distances(matrix[1:], matrix[:-1], metric)
+    if not len(jumps):
+        jumps = np.zeros(1)
+        steps = np.zeros((1, matrix.shape[1]))
+
+    metrics = {"tracks": n,
+               "total": float(jumps.sum()),
+               "mean": float(jumps.mean()),
+               "max": float(jumps.max())}
+    for p, value in zip(PERCENTILES, np.percentile(jumps, PERCENTILES)):
+        metrics["p{}".format(p)] = float(value)
+
+    # the mean absolute difference over all pairs, from the sorted values:
+    # the i-th smallest of n is larger than i others and smaller than n-1-i
+    randomsteps = np.zeros(matrix.shape[1])
+    if n > 1:
+        ranks = 2 * np.arange(n) - n + 1
+        randomsteps = (np.sort(matrix, axis=0) * ranks[:, None]).sum(axis=0) \
+            * 2.0 / (n * (n - 1))
+    smoothness = np.where(randomsteps > 0,
+                          steps.mean(axis=0) / np.maximum(randomsteps, 1e-12),
+                          0.0)
+    metrics["smoothness"] = dict(zip(ATTRIBUTES, smoothness.tolist()))
+    return(metrics)
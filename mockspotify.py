@@ -0,0 +1,346 @@
+# Stand-in for the parts of the spotify accounts service and web API that
+# clplaylistflow.py uses, for load testing (see loadtest.py) without sending
+# anything to spotify. Run it, then point the web and worker processes at it:
+#
+#     python mockspotify.py --port 5001 --latency 0.05 --ratelimit 0.01
+#     SPOTIFY_API_URL=http://localhost:5001 \
+#     SPOTIFY_ACCOUNTS_URL=http://localhost:5001 python playlistflow.py
+#
+# Every login is a new user (or one of --users, to exercise the caches), who
+# has --playlists playlists of up to --tracks tracks drawn from a catalog of
+# --catalog tracks, with audio features like spotify's (see benchmark.py).
+# The same user, playlist and track always look the same. Playlists created
+# through it are kept in memory. Each API request can be delayed (--latency,
+# --jitter) and a share of them (--ratelimit) answered with a 429 and a
+# Retry-After header instead. /mock/stats counts the requests by endpoint.
+
+import argparse
+import itertools
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+
+from flask import Flask, jsonify, redirect, request
+
+try:
+    from urllib import urlencode
+except ImportError: # python 3
+    from urllib.parse import urlencode
+
+import numpy as np
+
+import benchmark
+
+app = Flask(__name__)
+
+# set by configure
+options = None
+catalog = None # audio feature name -> array, a value per catalog track
+
+lock = threading.Lock()
+logins = itertools.count()
+created = {} # playlist id -> {"owner", "name", "uris", "version"}
+counts = Counter() # requests by endpoint, and "429" for those refused
+
+def configure(args):
+    """
+        Set the options of the mock and generate its catalog of tracks.
+    """
+    global options, catalog
+    options = args
+    catalog = benchmark.realisticfeatures(args.catalog,
+                                          np.random.RandomState(args.seed))
+
+def seed(*values):
+    """
+        Returns a random number generator seeded by values (e.g. a user id),
+        so the same values always give the same data.
+    """
+    key = ":".join(str(value) for value in (options.seed,) + values)
+    return(np.random.RandomState(zlib.crc32(key.encode("utf-8")) & 0xffffffff))
+
+def trackid(index):
+
+    return("mock{:018d}".format(index))
+
+def trackindex(trackid):
+    """
+        Returns the catalog index of a track id, or None if it isn't one.
+    """
+    try:
+        index = int(trackid[4:])
+    except ValueError:
+        return(None)
+    if not trackid.startswith("mock") or not 0 <= index < options.catalog:
+        return(None)
+    return(index)
+
+def userplaylists(userid):
+    """
+        Returns the list of ids of a user's generated playlists.
+    """
+    return(["{}p{}".format(userid, i) for i in range(options.playlists)])
+
+def playlisttracks(playlistid):
+    """
+        Returns the list of track URIs on a playlist, generated or created.
+    """
+    with lock:
+        if playlistid in created:
+            return(list(created[playlistid]["uris"]))
+    rng = seed(playlistid)
+    length = rng.randint(1, options.tracks + 1)
+    return(["spotify:track:{}".format(trackid(index))
+            for index in rng.randint(0, options.catalog, length)])
+
+def trackobject(uri):
+
+    index = trackindex(uri.split(":")[-1])
+    return({"id": uri.split(":")[-1], "uri": uri,
+            "name": "Track {}".format(index),
+            "album": {"name": "Album {}".format(index // 12)},
+            "artists": [{"name": "Artist {}".format(index // 40)}],
+            "popularity": int(seed("popularity", index).randint(0, 101))})
+
+def features(trackid):
+    """
+        Returns the audio features of a catalog track as the /audio-features
+        endpoint gives them, or None for an unknown id.
+    """
+    index = trackindex(trackid)
+    if index is None:
+        return(None)
+    result = {"id": trackid, "uri": "spotify:track:{}".format(trackid),
+              "type": "audio_features"}
+    for name, values in catalog.items():
+        value = values[index]
+        result[name] = int(value) if values.dtype.kind == "i" else float(value)
+    return(result)
+
+def page(items, offset, limit, maximum, build=None):
+    """
+        Returns a page of items like spotify's paged endpoints do, with the
+        limit capped at the endpoint's maximum and the mock's --pagesize.
+        If "build" is given, it makes the object returned for each item on
+        the page, so only that page's objects are made.
+    """
+    limit = min(limit, maximum, options.pagesize or maximum)
+    pageitems = items[offset:offset + limit]
+    if build is not None:
+        pageitems = [build(item) for item in pageitems]
+    return({"items": pageitems, "offset": offset, "limit": limit,
+            "total": len(items)})
+
+def error(status, message):
+
+    response = jsonify(error={"status": status, "message": message})
+    response.status_code = status
+    return(response)
+
+def userfromtoken():
+    """
+        Returns the user id an access token in the Authorization header was
+        issued to, or None if there isn't one.
+    """
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return(None)
+    return(header[len("Bearer "):].split(".")[0] or None)
+
+@app.before_request
+def simulate():
+    """
+        Delay each request, and answer some API requests with a 429.
+    """
+    with lock:
+        counts[str(request.endpoint)] += 1
+    if request.endpoint in ("mockstats", "authorize"):
+        return(None)
+    if options.latency or options.jitter:
+        time.sleep(max(0, random.gauss(options.latency, options.jitter)))
+    if request.path.startswith("/v1/") and random.random() < options.ratelimit:
+        with lock:
+            counts["429"] += 1
+        response = error(429, "API rate limit exceeded")
+        response.headers["Retry-After"] = str(options.retryafter)
+        return(response)
+    return(None)
+
+@app.route("/authorize/", strict_slashes=False)
+def authorize():
+    """
+        Log in straight away, as a new user, and send them back to the app.
+    """
+    with lock:
+        login = next(logins)
+    if options.users:
+        login = login % options.users
+    query = urlencode({"code": "user{}".format(login),
+                       "state": request.args.get("state", "")})
+    return(redirect("{}?{}".format(request.args["redirect_uri"], query)))
+
+@app.route("/api/token", methods=["POST"])
+def token():
+
+    if request.form.get("grant_type") == "refresh_token":
+        userid = request.form.get("refresh_token", "").split(".")[0]
+    else:
+        userid = request.form.get("code")
+    if not userid:
+        return(error(400, "invalid_grant"))
+    return(jsonify(access_token="{}.{:x}".format(userid,
+                                                 random.getrandbits(64)),
+                   token_type="Bearer", expires_in=options.expires,
+                   refresh_token="{}.refresh".format(userid)))
+
+@app.route("/v1/me")
+def me():
+
+    userid = userfromtoken()
+    if userid is None:
+        return(error(401, "No token provided"))
+    return(jsonify(id=userid))
+
+@app.route("/v1/me/playlists")
+def myplaylists():
+
+    userid = userfromtoken()
+    if userid is None:
+        return(error(401, "No token provided"))
+    items = [{"id": playlistid, "name": "Playlist {}".format(playlistid),
+              "owner": {"id": userid}, "snapshot_id": "snapshot1",
+              "images": [{"url": "https://example.com/{}.jpg"
+                          .format(playlistid)}]}
+             for playlistid in userplaylists(userid)]
+    with lock:
+        items.extend({"id": playlistid, "name": playlist["name"],
+                      "owner": {"id": userid}, "images": [],
+                      "snapshot_id": "snapshot{}".format(playlist["version"])}
+                     for playlistid, playlist in sorted(created.items())
+                     if playlist["owner"] == userid)
+    return(jsonify(**page(items, request.args.get("offset", 0, type=int),
+                          request.args.get("limit", 20, type=int), 50)))
+
+@app.route("/v1/users/<ownerid>/playlists", methods=["POST"])
+def createplaylist(ownerid):
+
+    if userfromtoken() != ownerid:
+        return(error(403, "You cannot create a playlist for another user"))
+    with lock:
+        playlistid = "{}c{}".format(ownerid, len(created))
+        created[playlistid] = {"owner": ownerid,
+                               "name": request.get_json()["name"],
+                               "uris": [], "version": 1}
+    return(jsonify(id=playlistid, collaborative=False,
+                   name=request.get_json()["name"],
+                   external_urls={"spotify": "https://open.spotify.com/"
+                                  "playlist/{}".format(playlistid)}),
+           201)
+
+@app.route("/v1/users/<ownerid>/playlists/<playlistid>/tracks")
+def gettracks(ownerid, playlistid):
+
+    if userfromtoken() is None:
+        return(error(401, "No token provided"))
+    return(jsonify(**page(playlisttracks(playlistid),
+                          request.args.get("offset", 0, type=int),
+                          request.args.get("limit", 100, type=int), 100,
+                          lambda uri: {"track": trackobject(uri),
+                                       "is_local": False})))
+
+@app.route("/v1/users/<ownerid>/playlists/<playlistid>/tracks",
+           methods=["POST", "PUT", "DELETE"])
+def changetracks(ownerid, playlistid):
+    """
+        Add tracks to (POST), move a range of tracks within (PUT) or remove
+        tracks from (DELETE) a playlist created through the mock.
+    """
+    body = request.get_json()
+    with lock:
+        playlist = created.get(playlistid)
+        if playlist is None or playlist["owner"] != userfromtoken():
+            return(error(403, "You cannot change this playlist"))
+        uris = playlist["uris"]
+        if request.method == "POST":
+            position = body.get("position", len(uris))
+            if len(body["uris"]) > 100 or position > len(uris):
+                return(error(400, "Invalid request"))
+            uris[position:position] = body["uris"]
+        elif request.method == "PUT":
+            start = body["range_start"]
+            length = body.get("range_length", 1)
+            before = body["insert_before"]
+            if start + length > len(uris) or before > len(uris):
+                return(error(400, "Index out of bounds"))
+            moved = uris[start:start + length]
+            del uris[start:start + length]
+            if before > start:
+                before = before - length
+            uris[before:before] = moved
+        else:
+            remove = set()
+            for track in body["tracks"]:
+                for position in track["positions"]:
+                    if position >= len(uris) or uris[position] != track["uri"]:
+                        return(error(400, "Invalid track position"))
+                    remove.add(position)
+            uris[:] = [uri for i, uri in enumerate(uris) if i not in remove]
+        playlist["version"] = playlist["version"] + 1
+        snapshot = "snapshot{}".format(playlist["version"])
+    return(jsonify(snapshot_id=snapshot), 201 if request.method == "POST"
+           else 200)
+
+@app.route("/v1/audio-features/", strict_slashes=False)
+def audiofeatures():
+
+    if userfromtoken() is None:
+        return(error(401, "No token provided"))
+    ids = request.args.get("ids", "").split(",")
+    if len(ids) > 100:
+        return(error(400, "Too many ids requested"))
+    return(jsonify(audio_features=[features(trackid) for trackid in ids]))
+
+@app.route("/mock/stats")
+def mockstats():
+
+    with lock:
+        return(jsonify(**counts))
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description="Serve a stand-in for the spotify API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="mean seconds to delay each request by")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="standard deviation of the delay")
+    parser.add_argument("--ratelimit", type=float, default=0.0,
+                        help="share of API requests answered with a 429")
+    parser.add_argument("--retryafter", type=int, default=1,
+                        help="Retry-After seconds sent with each 429")
+    parser.add_argument("--pagesize", type=int, default=0,
+                        help="most items on a page, below the endpoint's own "
+                        "limit (0 for no extra limit)")
+    parser.add_argument("--users", type=int, default=0,
+                        help="logins cycle through this many users (0 for a "
+                        "new user each time)")
+    parser.add_argument("--playlists", type=int, default=60,
+                        help="playlists each user has")
+    parser.add_argument("--tracks", type=int, default=300,
+                        help="most tracks on each playlist")
+    parser.add_argument("--catalog", type=int, default=100000,
+                        help="distinct tracks the playlists are drawn from")
+    parser.add_argument("--expires", type=int, default=3600,
+                        help="seconds access tokens are valid for")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    configure(args)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
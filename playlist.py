@@ -8,11 +8,13 @@ class Playlist():
     def __init__(self):
 
         self.tracks = [] # list of track objects for tracks in playlist
+        self.table = None # TrackTable holding the values for those tracks
         self.images = None
         self.length = None
         self.name = None
         self.playlistid = None 
         self.ownerid = None
+        self.snapshotid = None # changes whenever the playlist does
 
     def __str__(self):
 
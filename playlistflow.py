@@ -1,18 +1,42 @@
-from flask import Flask, render_template, redirect, request, session
+from flask import Flask, render_template, redirect, request, session, jsonify, g
 from urlparse import urlparse, parse_qs
 import os
 import redis
-import pickle
+import json
 import logging
+import timeit
 import clplaylistflow as pf
-from user import User
+import profiling
+from flowprofiles import FlowProfile
+from instrument import instruments
+from jobs import JobQueue
+from sessionstore import SessionStore, uniquenames
+from tokens import TokenManager
 
 app = Flask(__name__)
 r = redis.from_url(os.environ.get("REDIS_URL"))
+sessions = SessionStore(r)
+jobqueue = JobQueue(r)
+tokens = TokenManager(sessions, pf.refreshtokens)
+instruments.connect(r)
 
 logging.basicConfig(filename="app.log", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@app.before_request
+def starttimer():
+    g.start = timeit.default_timer()
+
+@app.after_request
+def stoptimer(response):
+    # by route rather than url, so /status/<jobid> is one series
+    if "start" in g and request.url_rule is not None:
+        instruments.observe("request_seconds",
+                            timeit.default_timer() - g.start,
+                            route=request.url_rule.rule,
+                            status=response.status_code)
+    return(response)
+
 @app.route('/')
 def index():
     logger.debug('route: /')
@@ -21,20 +45,18 @@ def index():
 @app.route('/spotifylogin')
 def authenticate():
     logger.debug('route: /spotifylogin')
-    user = User()
-    user.state, url = pf.getauthenticationurl()
+    state, url = pf.getauthenticationurl()
 
     # clear old session
     session.clear()
 
     # add this user to sessions
-    session["state"] = user.state
+    session["state"] = state
 
-    # pickle and add to redis
-    userpickle = pickle.dumps(user)
-    r.setex(user.state, userpickle, 3600) # expire in an hour
+    # add to redis, expires an hour after the user's last request
+    sessions.create(state)
 
-    logger.debug('sent state {}'.format(user.state))
+    logger.debug('sent state {}'.format(state))
 
     return(redirect(url))
 
@@ -54,13 +76,9 @@ def callback():
         return("error: are cookies enabled? if not, try enabling them.")
         # TODO: server error page/ redirect to index
 
-    # get user object from redis
-    userpickle = r.get(state)
-    if not userpickle:
+    # check the user is in redis
+    if sessions.get(state) is None:
         return('no user with state {} in DB'.format(state))
-    else:
-        user = pickle.loads(userpickle)
-        r.expire(state, 3600) # extend life of user in redis
 
     # get authorization code (or error code) from uri
     if 'code' in parseduri:
@@ -69,23 +87,82 @@ def callback():
         error = parseduri['error'][0]
         return(None)
 
-    user.accesstoken, user.refreshtoken = pf.requesttokens(code)
+    accesstoken, refreshtoken, expiresin = pf.requesttokens(code)
+    if not accesstoken:
+        return('error: could not log in to spotify')
 
     # have tokens, get userid
-    user.userid = pf.getuserid(user.accesstoken)
-
-    # build dict of user's playlists
-    user.playlists = pf.getplaylists(user.accesstoken, user.userid)
+    userid = pf.getuserid(accesstoken)
+    if not userid:
+        return('error: could not get spotify user id')
+
+    # the tokens, refreshed by TokenManager before they expire
+    tokens.store(state, accesstoken, refreshtoken, expiresin)
+    sessions.update(state, userid=userid)
+
+    # get the first page of the user's playlists to show straight away. the
+    # worker adds the rest to the session, and the page asks /playlists for
+    # more as they're wanted
+    playlists, total = pf.getplaylistpage(accesstoken, 0)
+    if playlists is None:
+        return('error: could not get playlists from spotify')
+    sessions.addplaylists(state, playlists, 0)
+    # counted by spotify's items, as playlists can share a name
+    complete = len(playlists) >= total
+    sessions.update(state, playlisttotal=total,
+                    playlistscomplete=1 if complete else 0)
+    if not complete:
+        jobqueue.enqueue({"type": "playlists", "state": state},
+                         dedupkey="playlists:{}".format(state))
+
+    playlistnames = uniquenames([x.name for x in playlists])
 
-    # write updated user object back to redis
-    userpickle = pickle.dumps(user)
-    r.setex(user.state, userpickle, 3600)
 
-    playlistnames = [x for x in user.playlists]
+    # find out which playlist is wanted
+    return(render_template('playlists.html', playlistnames=playlistnames,
+                           loaded=len(playlists), total=total))
 
+@app.route('/playlists')
+def playlists():
+    logger.debug('route: /playlists')
 
-    # find out which playlist is wanted
-    return(render_template('playlists.html', playlistnames=playlistnames))
+    # check cookie for state
+    if "state" not in session:
+        return(jsonify(error="no session"), 404)
+    state = session["state"]
+
+    user = sessions.get(state, "accesstoken", "playlisttotal",
+                        "playlistscomplete")
+    # no total if /callback stopped before it got the first playlists
+    if (user is None or not user["accesstoken"]
+            or user["playlisttotal"] is None):
+        return(jsonify(error="no session"), 404)
+
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return(jsonify(error="bad offset"), 400)
+    total = int(user["playlisttotal"])
+    complete = user["playlistscomplete"] == "1"
+
+    # use the page if the worker has added it already, otherwise get it
+    # from spotify now
+    names, count = sessions.playlistpage(state, offset, pf.PLAYLISTPAGESIZE)
+    if count < min(pf.PLAYLISTPAGESIZE, total - offset):
+        accesstoken = tokens.accesstoken(state)
+        if not accesstoken:
+            return(jsonify(error="no session"), 404)
+        playlists, total = pf.getplaylistpage(accesstoken, offset)
+        if playlists is None:
+            return(jsonify(error="could not get playlists from spotify"), 502)
+        sessions.addplaylists(state, playlists, offset)
+        names = uniquenames([x.name for x in playlists])
+        count = len(playlists)
+
+    # "count" is how many of the user's playlists the page covers, which is
+    # more than len(names) if some share a name
+    return(jsonify(names=names, count=count, offset=offset, total=total,
+                   complete=complete))
 
 @app.route('/selection')
 def selection():
@@ -99,42 +176,74 @@ def selection():
         return("error: are cookies enabled? if not, try enabling them.")
         # TODO: server error page/ redirect to index
 
-    # get user object from redis
-    userpickle = r.get(state)
-    if not userpickle:
+    # check the user is in redis (extending the life of their session)
+    if sessions.get(state) is None:
         return('no user with state {} in DB'.format(state))
-    else:
-        user = pickle.loads(userpickle)
-        r.expire(state, 3600) # extend life of user in redis
 
-    if request.args.get('choice'):
-        chosenplaylist = user.playlists[request.args.get('choice')]
-    else:
+    choice = request.args.get('choice')
+    if not choice or sessions.getplaylist(state, choice) is None:
         return('error')
 
-    # get list of the playlist's tracks
-    playlist = pf.getplaylisttracks(user.accesstoken, chosenplaylist)
-
-    # double check to make sure playlist isn't empty
-    if not playlist.tracks:
-        return("Looks like the playlist you chose doesn't have any songs in it (or only has non-spotify songs in it). Try a different one!")
-
-    logger.debug("tracks:\n{}".format(playlist.tracks))
-
-    # get info for each of that playlist's tracks
-    pf.gettrackinfo(user.accesstoken, playlist)
-
-    # run flow algorithm to determine correct order
-    newtracklist = pf.sortbyflow(playlist=playlist, flow="fastnn")
-    if not newtracklist:
-        return('error; newtracklist is None')
-
-    # create new playlist with that track order
-    playlistname, url = pf.createspotifyplaylist(user.accesstoken, playlist.name, user.playlists,
-                         newtracklist, user.userid)
+    # optional flow profile: a named set of attribute weights, how to
+    # normalize the attributes and how to measure the distance between songs
+    # (see flowprofiles.py)
+    try:
+        profile = FlowProfile(
+            weights=request.args.get('weights', 'default'),
+            normalization=request.args.get('normalization', 'fixed'),
+            metric=request.args.get('metric', 'euclidean'))
+    except ValueError:
+        return('error')
 
-    return(render_template("result.html", name=playlistname, url=url))
-    # return('playlist {} complete - enjoy!'.format(playlist.name))
+    # the worker process (worker.py) gets the playlist's tracks and their
+    # info, sorts them and creates the new playlist; result.html polls
+    # /status until it's done. asking for the same playlist again while
+    # that's happening gives back the same job. "nocache=1" in the url makes
+    # the worker sort the playlist again even if it has a result cached, and
+    # an admin can have the job profiled (see profiling.py)
+    nocache = request.args.get('nocache', '').lower() in ("1", "true")
+    jobid = jobqueue.enqueue({"state": state, "choice": choice,
+                              "flow": "fastnn",
+                              "flowprofile": {
+                                  "weights": profile.name,
+                                  "normalization": profile.normalization,
+                                  "metric": profile.metric},
+                              "nocache": nocache,
+                              "profile": profiling.requested(request.headers)},
+                             dedupkey="{}:{}:{}:{}:{}:{}".format(
+                                 state, choice, profile.name,
+                                 profile.normalization, profile.metric,
+                                 1 if nocache else 0))
+
+    return(render_template("result.html", jobid=jobid, choice=choice))
+
+@app.route('/status/<jobid>')
+def status(jobid):
+    logger.debug('route: /status')
+
+    # only the user who asked for a job can see it
+    job = jobqueue.status(jobid)
+    if (not job or "state" not in session
+            or json.loads(job["payload"])["state"] != session["state"]):
+        return(jsonify(status="unknown"), 404)
+
+    response = {"status": job["status"]}
+    if job["status"] == "done":
+        response["name"] = job["result"]["name"]
+        response["url"] = job["result"]["url"]
+    elif job["status"] == "failed":
+        response["error"] = job["error"]
+    return(jsonify(**response))
+
+@app.route('/metrics')
+def metrics():
+    # the totals of every web and worker process, for prometheus to scrape.
+    # if METRICSTOKEN is set it has to be given as ?token=
+    token = os.environ.get('METRICSTOKEN')
+    if token and request.args.get('token') != token:
+        return('error: not allowed', 403)
+    return(instruments.render(), 200,
+           {"Content-Type": "text/plain; version=0.0.4"})
 
 @app.route('/about')
 def about():
@@ -0,0 +1,263 @@
+# Profiling of individual jobs, to see where the time of a slow flow went
+# A job is profiled if the /selection request that made it carried the
+# X-Profile header set to PROFILETOKEN, or at random for a PROFILESAMPLE share
+# of jobs. It is run under cProfile and, on python 3, tracemalloc, and these
+# files are written to PROFILEDIR, named by the time and a random suffix:
+#
+#     <name>.prof      the cProfile stats, for pstats or a viewer like snakeviz
+#     <name>.snapshot  the tracemalloc snapshot at the end of the job (python
+#                      3 only)
+#     <name>.json      what the job was (type, flow, playlist size, ...), how
+#                      long it took, its peak traced memory and the lines that
+#                      allocated the most memory (python 3 only), and the
+#                      process's peak resident memory before and after it
+#
+# Python 2 has no tracemalloc, so there the peak resident memory is all
+# there is: it only grows when a job needs more memory than any before it.
+#
+# cProfile only sees the worker's own thread, so the time spent waiting for
+# spotify shows up as time waiting on the thread pools in clplaylistflow.
+# List and summarise stored profiles with
+#
+#     python profiling.py list
+#     python profiling.py show <name> [--sort tottime] [--limit 30]
+
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import random
+import string
+import sys
+import threading
+import time
+import timeit
+from contextlib import contextmanager
+
+try:
+    from StringIO import StringIO
+except ImportError: # python 3
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError: # not on windows
+    resource = None
+
+PROFILEDIR = os.environ.get("PROFILEDIR", "profiles")
+SAMPLERATE = float(os.environ.get("PROFILESAMPLE", 0))
+HEADER = "X-Profile"
+
+# lines allocating the most memory to keep in each profile's metadata
+TOPALLOCATIONS = 25
+
+local = threading.local()
+
+class Profile():
+
+    def __init__(self, directory=PROFILEDIR, **metadata):
+
+        self.directory = directory
+        self.metadata = metadata
+        self.name = "{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S"),
+            "".join(random.choice(string.ascii_lowercase + string.digits)
+                    for i in range(6)))
+        self.profiler = cProfile.Profile()
+        self.tracing = False
+
+    def __enter__(self):
+
+        # leave tracemalloc alone if something else is already using it
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        local.profile = self
+        self.peakrssbefore = peakrss()
+        self.start = timeit.default_timer()
+        self.profiler.enable()
+        return(self)
+
+    def __exit__(self, exctype, exc, tb):
+
+        self.profiler.disable()
+        seconds = timeit.default_timer() - self.start
+        local.profile = None
+
+        snapshot = None
+        peak = None
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        self.metadata.update(name=self.name, time=time.time(),
+                             seconds=seconds, peakbytes=peak,
+                             peakrssbefore=self.peakrssbefore,
+                             peakrssafter=peakrss(),
+                             error=None if exc is None else str(exc))
+        try:
+            self.save(snapshot)
+        except (IOError, OSError) as e:
+            print('error: could not save profile {}: {}'.format(self.name, e))
+        return(False)
+
+    def note(self, **fields):
+        """
+            Add fields to the profile's metadata, e.g. the playlist size once
+            it is known.
+        """
+        self.metadata.update(fields)
+
+    def save(self, snapshot):
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, self.name)
+        self.profiler.dump_stats(path + ".prof")
+        if snapshot is not None:
+            snapshot.dump(path + ".snapshot")
+            self.metadata["allocations"] = [
+                {"where": "{}:{}".format(stat.traceback[0].filename,
+                                         stat.traceback[0].lineno),
+                 "bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:TOPALLOCATIONS]]
+        with open(path + ".json", "w") as f:
+            f.write(json.dumps(self.metadata, indent=2, sort_keys=True)
+                    + "\n")
+        print('profile {} saved to {}'.format(self.name, self.directory))
+
+
+@contextmanager
+def profiled(enabled, directory=PROFILEDIR, **metadata):
+    """
+        Context manager that profiles its block if enabled is true, with the
+        given metadata (see Profile).
+    """
+    if not enabled:
+        yield None
+        return
+    with Profile(directory, **metadata) as profile:
+        yield profile
+
+
+def note(**fields):
+    """
+        Add fields to the metadata of the profile of this thread's job, if
+        it's being profiled.
+    """
+    profile = getattr(local, "profile", None)
+    if profile is not None:
+        profile.note(**fields)
+
+
+def requested(headers):
+    """
+        Returns True if a request's headers ask for its job to be profiled:
+        the X-Profile header holds PROFILETOKEN (which must be set).
+    """
+    token = os.environ.get("PROFILETOKEN")
+    return(bool(token) and headers.get(HEADER) == token)
+
+
+def sampled(payload):
+    """
+        Returns True if a job should be profiled: it was asked for, or it
+        was picked at random at PROFILESAMPLE.
+    """
+    return(bool(payload.get("profile")) or random.random() < SAMPLERATE)
+
+
+def peakrss():
+    """
+        Returns the peak resident memory of this process so far, in bytes,
+        or None where it can't be read.
+    """
+    if resource is None:
+        return(None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return(peak if sys.platform == "darwin" else peak * 1024)
+
+
+def listprofiles(directory=PROFILEDIR):
+    """
+        Returns the metadata of each profile in directory, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return([])
+    profiles = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename)) as f:
+                profiles.append(json.load(f))
+    return(sorted(profiles, key=lambda profile: profile["time"]))
+
+
+def summary(name, directory=PROFILEDIR, sort="cumulative", limit=30):
+    """
+        Returns a profile's metadata, the functions that took the most time
+        (ordered by "sort", any pstats sort key) and the lines that
+        allocated the most memory, as text.
+    """
+    path = os.path.join(directory, name)
+    with open(path + ".json") as f:
+        metadata = json.load(f)
+
+    lines = []
+    for key in sorted(metadata):
+        if key != "allocations":
+            lines.append("{}: {}".format(key, metadata[key]))
+
+    stream = StringIO()
+    stats = pstats.Stats(path + ".prof", stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    lines.append(stream.getvalue())
+
+    if metadata.get("allocations"):
+        lines.append("largest allocations:")
+        for allocation in metadata["allocations"][:limit]:
+            lines.append("{:>12} bytes {:>8} blocks  {}".format(
+                allocation["bytes"], allocation["count"],
+                allocation["where"]))
+    return("\n".join(lines))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="List and read profiles.")
+    parser.add_argument("--dir", default=PROFILEDIR,
+                        help="where the profiles are")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("list", help="list the stored profiles")
+    show = commands.add_parser("show", help="summarise one profile")
+    show.add_argument("name")
+    show.add_argument("--sort", default="cumulative",
+                      help="pstats sort key, e.g. cumulative or tottime")
+    show.add_argument("--limit", type=int, default=30)
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        print(summary(args.name, args.dir, args.sort, args.limit))
+        return
+
+    print("{:<22} {:<10} {:<9} {:>7} {:>9} {:>11} {:>11}".format(
+        "name", "type", "flow", "tracks", "seconds", "peak MB", "rss MB"))
+    for profile in listprofiles(args.dir):
+        peak = profile.get("peakbytes")
+        rss = profile.get("peakrssafter")
+        print("{:<22} {:<10} {:<9} {:>7} {:>9.2f} {:>11} {:>11}".format(
+            profile["name"], profile.get("type") or "",
+            profile.get("flow") or "", profile.get("tracks", ""),
+            profile["seconds"],
+            "" if peak is None else "{:.1f}".format(peak / 1e6),
+            "" if rss is None else "{:.1f}".format(rss / 1e6)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# SessionStore class to keep each logged in user's data in redis
+# Users are identified by the randomly generated state sent to spotify when
+# they log in. Each user's scalar fields (tokens, user id) are kept in one
+# redis hash and their playlists in a second hash mapping each playlist's
+# name to a compact JSON list, so a route can read or update just the fields
+# it needs instead of loading and saving everything at once. Nothing is
+# pickled. A third hash maps positions in the user's list of playlists (as
+# spotify numbers them, so playlists that share a name each have their own)
+# to names, so the list can be filled in a page at a time, in any order, and
+# read a page at a time. The keys expire "ttl" seconds after the user's last
+# request.
+#
+# The session hash holds the VERSION of this layout it was written with;
+# sessions written with another version are treated as logged out.
+
+import json
+import time
+
+from instrument import instruments
+from playlist import Playlist
+
+VERSION = 3
+
+class SessionStore():
+
+    def __init__(self, redisconnection, ttl=3600, prefix="session"):
+
+        self.redis = redisconnection
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def sessionkey(self, state):
+
+        return("{}:{}".format(self.prefix, state))
+
+    def playlistskey(self, state):
+
+        return("{}:{}:playlists".format(self.prefix, state))
+
+    def positionskey(self, state):
+
+        return("{}:{}:positions".format(self.prefix, state))
+
+    def keys(self, state):
+
+        return([self.sessionkey(state), self.playlistskey(state),
+                self.positionskey(state)])
+
+    @instruments.timed("redis_seconds", op="session.create")
+    def create(self, state):
+        """
+            Start a new, empty session for state.
+        """
+        pipe = self.redis.pipeline()
+        pipe.delete(*self.keys(state))
+        pipe.hmset(self.sessionkey(state), {"version": VERSION,
+                                            "created": time.time()})
+        pipe.expire(self.sessionkey(state), self.ttl)
+        pipe.execute()
+
+    @instruments.timed("redis_seconds", op="session.get")
+    def get(self, state, *fields):
+        """
+            Read the given fields of a session (e.g. "accesstoken", "userid")
+            and extend its life.
+
+            Returns a dict mapping each field to its value (None if it isn't
+            set), or None if there is no session for state.
+        """
+        pipe = self.redis.pipeline()
+        pipe.hmget(self.sessionkey(state), ("version",) + fields)
+        for key in self.keys(state):
+            pipe.expire(key, self.ttl)
+        values = [decode(value) for value in pipe.execute()[0]]
+        if values[0] != str(VERSION):
+            return(None)
+        return(dict(zip(fields, values[1:])))
+
+    @instruments.timed("redis_seconds", op="session.update")
+    def update(self, state, **fields):
+        """
+            Set fields of a session, given as keyword arguments.
+        """
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.sessionkey(state), fields)
+        pipe.expire(self.sessionkey(state), self.ttl)
+        pipe.execute()
+
+    @instruments.timed("redis_seconds", op="session.addplaylists")
+    def addplaylists(self, state, playlists, start=0):
+        """
+            Add a page of the user's playlists to a session: a list of
+            Playlist objects, one for each item spotify returned (see
+            clplaylistflow.getplaylistpage), the first of which is at
+            position "start" of the user's list of playlists. Of playlists
+            that share a name, the last one added is the one kept. Adding the
+            same page again changes nothing.
+        """
+        if not playlists:
+            return
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.playlistskey(state),
+                   dict((playlist.name, pack(start + i, playlist))
+                        for i, playlist in enumerate(playlists)))
+        pipe.hmset(self.positionskey(state),
+                   dict((start + i, playlist.name)
+                        for i, playlist in enumerate(playlists)))
+        pipe.expire(self.playlistskey(state), self.ttl)
+        pipe.expire(self.positionskey(state), self.ttl)
+        pipe.execute()
+
+    @instruments.timed("redis_seconds", op="session.getplaylist")
+    def getplaylist(self, state, name):
+        """
+            Returns the Playlist object for the user's playlist called name,
+            or None if there isn't one.
+        """
+        packed = self.redis.hget(self.playlistskey(state), name)
+        if packed is None:
+            return(None)
+        return(unpack(name, packed))
+
+    @instruments.timed("redis_seconds", op="session.playlistpage")
+    def playlistpage(self, state, offset, limit):
+        """
+            Returns a list of the names of the user's playlists at positions
+            offset to offset + limit - 1, in order, leaving out any not
+            added yet and any name already in the list, and the number of
+            those positions that have been added.
+        """
+        names = self.redis.hmget(self.positionskey(state),
+                                 list(range(offset, offset + limit)))
+        added = [decode(name) for name in names if name is not None]
+        return(uniquenames(added), len(added))
+
+    @instruments.timed("redis_seconds", op="session.playlistnames")
+    def playlistnames(self, state):
+        """
+            Returns a list of the names of all the user's playlists added so
+            far, in no particular order.
+        """
+        return([decode(name)
+                for name in self.redis.hkeys(self.playlistskey(state))])
+
+    def delete(self, state):
+
+        self.redis.delete(*self.keys(state))
+
+
+def uniquenames(names):
+    """
+        Returns a list of names in the same order, without repeats.
+    """
+    seen = set()
+    unique = []
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            unique.append(name)
+    return(unique)
+
+
+def pack(position, playlist):
+    """
+        Returns a Playlist object, and its position in the user's list of
+        playlists, as a compact JSON list.
+    """
+    image = playlist.images[0]["url"] if playlist.images else None
+    return(json.dumps([position, playlist.playlistid, playlist.ownerid, image,
+                       playlist.snapshotid], separators=(",", ":")))
+
+
+def unpack(name, packed):
+    """
+        Returns the Playlist object called name packed by pack.
+    """
+    position, playlistid, ownerid, image, snapshotid = \
+        json.loads(decode(packed))
+    playlist = Playlist()
+    playlist.name = decode(name)
+    playlist.playlistid = playlistid
+    playlist.ownerid = ownerid
+    playlist.images = [{"url": image}] if image else []
+    playlist.snapshotid = snapshotid
+    return(playlist)
+
+
+def decode(value):
+    """
+        Returns a value read from redis as text, as playlist names can be
+        any unicode.
+    """
+    if isinstance(value, bytes):
+        return(value.decode("utf-8"))
+    return(value)
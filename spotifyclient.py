@@ -0,0 +1,155 @@
+# SpotifyClient class that every request to the spotify web API goes through
+# A single requests.Session keeps a pool of open (keep-alive) connections to
+# each host, so requests after the first skip the TCP and TLS handshakes.
+# Rate limited (429) and server error (5xx) responses, and connections that
+# fail outright, are retried by one policy: wait as long as a Retry-After
+# header asks, or else back off exponentially, with random jitter so that
+# concurrent requests don't all come back at once, until either "maxretries"
+# retries or "maxwait" seconds of waiting in total have been used up. A rate
+# limited response pauses every request made through the client, not just
+# the one that got it, until its Retry-After has passed, so that many
+# requests at once (e.g. a batch of playlists) back off together instead of
+# each running into the limit in turn.
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrument import instruments
+
+class SpotifyClient():
+
+    def __init__(self, poolsize=16, maxretries=6, maxwait=60, backoff=0.5,
+                 timeout=15):
+
+        self.maxretries = maxretries
+        self.maxwait = maxwait # seconds spent waiting at most per request
+        self.backoff = backoff # first wait after a 5xx or failed connection
+        self.timeout = timeout # seconds to wait for a response
+
+        self.lock = threading.Lock()
+        self.pauseuntil = 0 # no requests before this time, after a 429
+
+        # connections kept open per host, enough for every concurrent request
+        # (see clplaylistflow.PAGEWORKERS)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, accesstoken, key, params=None):
+        """
+            GET url with the given query parameters. See request.
+
+            Returns the response as a dict, or None if there is an error.
+        """
+        return(self.request("GET", url, accesstoken, key, params=params))
+
+    def post(self, url, accesstoken, key, json=None, data=None,
+             retryerrors=True):
+        """
+            POST a JSON body (or form data) to url. See request.
+
+            Returns the response as a dict, or None if there is an error.
+        """
+        return(self.request("POST", url, accesstoken, key, retryerrors,
+                            json=json, data=data))
+
+    def request(self, method, url, accesstoken, key, retryerrors=True,
+                **kwargs):
+        """
+            Send a request, authorized with accesstoken if one is given, and
+            retry it as long as the retry policy allows. "key" is a field a
+            successful response has, e.g. "items". If "retryerrors" is False
+            only rate limited requests are retried, for requests that aren't
+            safe to send twice (a failed connection or 5xx response doesn't
+            mean the request wasn't carried out).
+
+            Returns the response as a dict, or None if there is an error.
+        """
+        headers = {}
+        if accesstoken:
+            headers["Authorization"] = "Bearer {}".format(accesstoken)
+
+        waited = 0
+        retries = 0
+        while True:
+            self.waitforpause()
+            try:
+                with instruments.timer("spotify_request_seconds",
+                                       method=method):
+                    r = self.session.request(method, url, headers=headers,
+                                             timeout=self.timeout, **kwargs)
+                response = self.parse(r)
+                status = r.status_code
+            except requests.exceptions.RequestException as e:
+                r = None
+                response = {"error": {"status": None, "message": str(e)}}
+                status = None
+            instruments.count("spotify_requests_total", method=method,
+                              status=status or "none")
+
+            if key in response:
+                return(response)
+
+            if status == 429 or (retryerrors
+                                 and (status is None or status >= 500)):
+                wait = self.waittime(r, retries)
+                if status == 429:
+                    self.pause(wait)
+                if retries < self.maxretries and waited + wait <= self.maxwait:
+                    instruments.count("spotify_retries_total")
+                    instruments.count("spotify_retry_sleep_seconds_total", wait)
+                    time.sleep(wait)
+                    waited = waited + wait
+                    retries = retries + 1
+                    continue
+
+            instruments.count("spotify_failures_total", method=method)
+            print('error: {} request to {} failed'.format(method, url))
+            print(response.get("error", response))
+            return(None)
+
+    def pause(self, seconds):
+        """
+            Hold back every request for the next "seconds" seconds.
+        """
+        with self.lock:
+            self.pauseuntil = max(self.pauseuntil, time.time() + seconds)
+
+    def waitforpause(self):
+        """
+            Sleep until any pause started by a rate limited response is over.
+        """
+        delay = self.pauseuntil - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def parse(self, r):
+        """
+            Returns the JSON body of response r as a dict, or a dict with an
+            "error" entry if it doesn't have one (e.g. an HTML error page).
+        """
+        try:
+            response = r.json()
+        except ValueError:
+            response = None
+        if not isinstance(response, dict):
+            response = {"error": {"status": r.status_code, "message": r.text}}
+        return(response)
+
+    def waittime(self, r, retries):
+        """
+            Seconds to wait before retry number "retries" + 1: the
+            Retry-After header of response r if it has one, otherwise
+            exponential backoff, either way plus random jitter.
+        """
+        if r is not None and "Retry-After" in r.headers:
+            try:
+                return(int(r.headers["Retry-After"]) + random.uniform(0, 1))
+            except ValueError:
+                pass
+        return(self.backoff * (2 ** retries) * random.uniform(0.5, 1.5))
@@ -0,0 +1,19 @@
+# Shared setup for the tests, which need pytest and fakeredis (standing in
+# for a redis server) on top of requirements.txt:
+#
+#     pip install pytest fakeredis
+#     python -m pytest tests
+
+import os
+import sys
+
+import fakeredis
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def redisconnection():
+
+    return(fakeredis.FakeStrictRedis())
@@ -0,0 +1,90 @@
+# A cached flow result must only be found for the same tracks, in the same
+# order, sorted with the same flow and parameters, and nothing is cached
+# when the cache is bypassed.
+
+import pytest
+
+from flowcache import FlowCache
+
+TRACKIDS = ["track{}".format(i) for i in range(5)]
+ORDER = ["spotify:track:track{}".format(i) for i in (3, 1, 4, 0, 2)]
+PARAMS = {"size": 50, "refine": True,
+          "profile": {"weights": [1.0, 2.0], "normalization": "fixed",
+                      "metric": "euclidean"}}
+
+@pytest.fixture
+def flowcache(redisconnection):
+
+    return(FlowCache(redisconnection))
+
+def testresult(flowcache):
+
+    assert flowcache.get(TRACKIDS, "fastnn", PARAMS) is None
+    flowcache.set(TRACKIDS, "fastnn", PARAMS, ORDER)
+    assert flowcache.get(TRACKIDS, "fastnn", PARAMS) == ORDER
+    # the same parameters, built in another order
+    assert flowcache.get(TRACKIDS, "fastnn", dict(reversed(
+        list(PARAMS.items())))) == ORDER
+
+def testkey(flowcache):
+
+    flowcache.set(TRACKIDS, "fastnn", PARAMS, ORDER)
+    assert flowcache.get(TRACKIDS[::-1], "fastnn", PARAMS) is None
+    assert flowcache.get(TRACKIDS[:-1], "fastnn", PARAMS) is None
+    assert flowcache.get(TRACKIDS, "cluster", PARAMS) is None
+    assert flowcache.get(TRACKIDS, "fastnn", dict(PARAMS, size=40)) is None
+    profile = dict(PARAMS["profile"], metric="cosine")
+    assert flowcache.get(TRACKIDS, "fastnn",
+                         dict(PARAMS, profile=profile)) is None
+
+def testsnapshot(flowcache):
+
+    flowcache.set(TRACKIDS, "fastnn", PARAMS, ORDER, "playlist", "snapshot1")
+    assert flowcache.getsnapshot("playlist", "snapshot1", "fastnn",
+                                 PARAMS) == ORDER
+    assert flowcache.getsnapshot("playlist", "snapshot2", "fastnn",
+                                 PARAMS) is None
+    assert flowcache.getsnapshot("playlist", "snapshot1", "cluster",
+                                 PARAMS) is None
+    assert flowcache.getsnapshot("playlist", None, "fastnn", PARAMS) is None
+
+    # a new snapshot with the same tracks, its result found by get
+    flowcache.setsnapshot(TRACKIDS, "fastnn", PARAMS, "playlist", "snapshot2")
+    assert flowcache.getsnapshot("playlist", "snapshot2", "fastnn",
+                                 PARAMS) == ORDER
+
+def testbypass(redisconnection):
+
+    flowcache = FlowCache(redisconnection, bypass=True)
+    flowcache.set(TRACKIDS, "fastnn", PARAMS, ORDER, "playlist", "snapshot")
+    flowcache.setsnapshot(TRACKIDS, "fastnn", PARAMS, "playlist", "snapshot")
+    assert redisconnection.keys("*") == []
+    assert flowcache.get(TRACKIDS, "fastnn", PARAMS) is None
+
+    # nor is anything stored without it looked up
+    FlowCache(redisconnection).set(TRACKIDS, "fastnn", PARAMS, ORDER,
+                                   "playlist", "snapshot")
+    assert flowcache.get(TRACKIDS, "fastnn", PARAMS) is None
+    assert flowcache.getsnapshot("playlist", "snapshot", "fastnn",
+                                 PARAMS) is None
+
+def testexpired(redisconnection):
+
+    flowcache = FlowCache(redisconnection, ttl=-1)
+    flowcache.set(TRACKIDS, "fastnn", PARAMS, ORDER, "playlist", "snapshot")
+    assert flowcache.get(TRACKIDS, "fastnn", PARAMS) is None
+    assert flowcache.getsnapshot("playlist", "snapshot", "fastnn",
+                                 PARAMS) is None
+
+def testrotate(redisconnection):
+
+    flowcache = FlowCache(redisconnection, maxentries=4)
+    orders = {}
+    for i in range(5):
+        trackids = ["only{}".format(i)]
+        orders[i] = ["spotify:track:only{}".format(i)]
+        flowcache.set(trackids, "fastnn", PARAMS, orders[i])
+    # the older hash keeps the last entries before the rotation
+    assert flowcache.get(["only0"], "fastnn", PARAMS) is None
+    assert flowcache.get(["only3"], "fastnn", PARAMS) == orders[3]
+    assert flowcache.get(["only4"], "fastnn", PARAMS) == orders[4]
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# A session's fields and playlists must come back from redis as they were
+# stored, and its playlists can be added and read a page at a time, in any
+# order.
+
+import pytest
+
+from playlist import Playlist
+from sessionstore import SessionStore
+
+def makeplaylist(name, number):
+
+    playlist = Playlist()
+    playlist.name = name
+    playlist.playlistid = "playlist{}".format(number)
+    playlist.ownerid = "owner{}".format(number)
+    playlist.images = [{"url": "https://i.scdn.co/image/{}".format(number)}]
+    playlist.snapshotid = "snapshot{}".format(number)
+    return(playlist)
+
+@pytest.fixture
+def sessions(redisconnection):
+
+    sessions = SessionStore(redisconnection)
+    sessions.create("state")
+    return(sessions)
+
+def testfields(sessions):
+
+    sessions.update("state", accesstoken="access", userid="user",
+                    playlisttotal=3)
+    assert sessions.get("state", "accesstoken", "userid", "playlisttotal",
+                        "refreshtoken") == {"accesstoken": "access",
+                                            "userid": "user",
+                                            "playlisttotal": "3",
+                                            "refreshtoken": None}
+
+    # only the fields given change
+    sessions.update("state", accesstoken="newer")
+    assert sessions.get("state", "accesstoken", "userid") == \
+        {"accesstoken": "newer", "userid": "user"}
+
+def testnosession(sessions):
+
+    assert sessions.get("other", "accesstoken") is None
+    sessions.delete("state")
+    assert sessions.get("state", "accesstoken") is None
+
+def testotherversion(sessions, redisconnection):
+
+    redisconnection.hset(sessions.sessionkey("state"), "version", 1)
+    assert sessions.get("state", "accesstoken") is None
+
+def testplaylist(sessions):
+
+    stored = makeplaylist(u"Läuft – 夜", 1)
+    sessions.addplaylists("state", [stored])
+    playlist = sessions.getplaylist("state", u"Läuft – 夜")
+    assert playlist.name == u"Läuft – 夜"
+    assert playlist.playlistid == stored.playlistid
+    assert playlist.ownerid == stored.ownerid
+    assert playlist.images == stored.images
+    assert playlist.snapshotid == stored.snapshotid
+    assert sessions.getplaylist("state", "missing") is None
+
+def testnoimage(sessions):
+
+    stored = makeplaylist("plain", 1)
+    stored.images = []
+    sessions.addplaylists("state", [stored])
+    assert sessions.getplaylist("state", "plain").images == []
+
+def testpages(sessions):
+
+    names = ["a", "b", "a", "c", "d", "e"]
+    playlists = [makeplaylist(name, i) for i, name in enumerate(names)]
+
+    # the second page before the first
+    sessions.addplaylists("state", playlists[3:], 3)
+    assert sessions.playlistpage("state", 0, 3) == ([], 0)
+    assert sessions.playlistpage("state", 3, 3) == (["c", "d", "e"], 3)
+
+    # the repeated name is listed once, but both positions count
+    sessions.addplaylists("state", playlists[:3], 0)
+    assert sessions.playlistpage("state", 0, 3) == (["a", "b"], 3)
+    assert sessions.playlistpage("state", 4, 5) == (["d", "e"], 2)
+    assert sorted(sessions.playlistnames("state")) == ["a", "b", "c", "d", "e"]
+
+    # of playlists sharing a name the last added is kept
+    assert sessions.getplaylist("state", "a").playlistid == "playlist2"
+
+    # adding a page again changes nothing
+    sessions.addplaylists("state", playlists[:3], 0)
+    assert sessions.playlistpage("state", 0, 6) == (
+        ["a", "b", "c", "d", "e"], 6)
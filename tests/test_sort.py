@@ -0,0 +1,52 @@
+# The nearest neighbor flows computed different ways (vectornnflow with
+# numpy, kdnnflow with a k-d tree) must give exactly the order of the plain
+# one (fullnnflow), for every flow profile they take, on each of the
+# benchmark's feature distributions.
+
+import itertools
+
+import pytest
+
+import benchmark
+import sort
+from flowprofiles import FlowProfile, METRICS, NORMALIZATIONS, PROFILES
+
+TRACKS = 150
+
+def profiles(metrics=METRICS):
+
+    return([FlowProfile(weights, normalization, metric)
+            for weights, normalization, metric
+            in itertools.product(PROFILES, NORMALIZATIONS, metrics)])
+
+def trackids(tracks):
+
+    return([track.trackid for track in tracks])
+
+@pytest.mark.parametrize("distribution", list(benchmark.DISTRIBUTIONS))
+def testvectornnmatchesfullnn(distribution):
+
+    playlist = benchmark.makeplaylist(TRACKS, distribution, seed=1)
+    for profile in profiles():
+        assert (trackids(sort.vectornnflow(playlist, profile))
+                == trackids(sort.fullnnflow(playlist, profile))), profile.key()
+
+def testemptyplaylist():
+
+    playlist = benchmark.makeplaylist(0)
+    assert sort.vectornnflow(playlist) == []
+    assert sort.kdnnflow(playlist) == []
+
+@pytest.mark.parametrize("distribution", list(benchmark.DISTRIBUTIONS))
+def testkdnnmatchesfullnn(distribution):
+
+    playlist = benchmark.makeplaylist(TRACKS, distribution, seed=1)
+    for profile in profiles(["euclidean", "cosine"]):
+        assert (trackids(sort.kdnnflow(playlist, profile))
+                == trackids(sort.fullnnflow(playlist, profile))), profile.key()
+
+def testkdnnrefusesmanhattan():
+
+    playlist = benchmark.makeplaylist(10)
+    with pytest.raises(ValueError):
+        sort.kdnnflow(playlist, FlowProfile(metric="manhattan"))
@@ -0,0 +1,110 @@
+# An access token must be refreshed once it has less than the margin left,
+# and not before, and a failed or stuck refresh must fall back to the old
+# token only while it is still valid.
+
+import time
+
+import pytest
+
+from sessionstore import SessionStore
+from tokens import TokenManager
+
+MARGIN = 600
+
+class Refresher():
+    """
+        Stands in for clplaylistflow.refreshtokens, counting its calls.
+    """
+
+    def __init__(self, result=("newaccess", "newrefresh", 3600)):
+
+        self.result = result
+        self.calls = []
+
+    def __call__(self, refreshtoken):
+
+        self.calls.append(refreshtoken)
+        return(self.result)
+
+@pytest.fixture
+def sessions(redisconnection):
+
+    sessions = SessionStore(redisconnection)
+    sessions.create("state")
+    return(sessions)
+
+def manager(sessions, refresh, **kwargs):
+
+    return(TokenManager(sessions, refresh, margin=MARGIN, **kwargs))
+
+def testfresh(sessions):
+
+    refresh = Refresher()
+    tokens = manager(sessions, refresh)
+    tokens.store("state", "access", "refresh", MARGIN + 60)
+    assert tokens.accesstoken("state") == "access"
+    assert refresh.calls == []
+
+def testwithinmargin(sessions):
+
+    refresh = Refresher()
+    tokens = manager(sessions, refresh)
+    tokens.store("state", "access", "refresh", MARGIN - 60)
+    assert tokens.accesstoken("state") == "newaccess"
+    assert refresh.calls == ["refresh"]
+
+    # the new tokens are kept, and good for another hour
+    user = sessions.get("state", "accesstoken", "refreshtoken", "expiresat")
+    assert user["accesstoken"] == "newaccess"
+    assert user["refreshtoken"] == "newrefresh"
+    assert float(user["expiresat"]) == pytest.approx(time.time() + 3600,
+                                                     abs=5)
+    assert tokens.accesstoken("state") == "newaccess"
+    assert refresh.calls == ["refresh"]
+
+def testunknownexpiry(sessions):
+
+    refresh = Refresher()
+    tokens = manager(sessions, refresh)
+    sessions.update("state", accesstoken="access", refreshtoken="refresh")
+    assert tokens.accesstoken("state") == "newaccess"
+
+def testfailedrefresh(sessions):
+
+    tokens = manager(sessions, Refresher((None, None, None)))
+    # still valid, so better than nothing
+    tokens.store("state", "access", "refresh", 60)
+    assert tokens.accesstoken("state") == "access"
+    # expired
+    tokens.store("state", "access", "refresh", -60)
+    assert tokens.accesstoken("state") is None
+
+def testnorefreshtoken(sessions):
+
+    refresh = Refresher()
+    tokens = manager(sessions, refresh)
+    sessions.update("state", accesstoken="access",
+                    expiresat=time.time() - 60)
+    assert tokens.accesstoken("state") is None
+    assert refresh.calls == []
+
+def testnosession(sessions):
+
+    tokens = manager(sessions, Refresher())
+    assert tokens.accesstoken("other") is None
+
+def testotherprocessrefreshing(sessions, redisconnection):
+
+    refresh = Refresher()
+    tokens = manager(sessions, refresh, locktimeout=1, poll=0.01)
+    tokens.store("state", "access", "refresh", 60)
+    redisconnection.set(tokens.lockkey("state"), 1)
+
+    # it gives up waiting and uses the old token, which hasn't expired
+    assert tokens.accesstoken("state") == "access"
+    assert refresh.calls == []
+
+    # the other process's new token is used once it's there
+    tokens.store("state", "theirs", "refresh", 3600)
+    assert tokens.accesstoken("state") == "theirs"
+    assert refresh.calls == []
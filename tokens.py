@@ -0,0 +1,103 @@
+# TokenManager class to keep each user's spotify access token valid
+# Access tokens last an hour. The session holds the time the token expires
+# ("expiresat") along with the refresh token, and accesstoken() gets a new
+# token with the refresh token once the old one has less than "margin"
+# seconds left, so a job never starts with a token that could run out
+# partway through (a flow job, refinement included, takes well under the
+# 600 seconds of margin). Only one process refreshes a user's token at a time,
+# holding a lock in redis; any others asking at the same time wait for its
+# result rather than refreshing again (spotify may replace the refresh token,
+# so two refreshes at once could leave the session with a stale one). The
+# new tokens are written back to the session.
+
+import time
+
+from instrument import instruments
+
+class TokenManager():
+
+    def __init__(self, sessions, refresh, margin=600, locktimeout=30,
+                 poll=0.1):
+
+        self.sessions = sessions # SessionStore the tokens are kept in
+        self.redis = sessions.redis
+        self.refresh = refresh # refreshtoken -> (access, refresh, expiresin)
+        self.margin = margin # seconds of validity left to refresh at
+        self.locktimeout = locktimeout # seconds to wait for another refresh
+        self.poll = poll # seconds between checks while waiting
+
+    def lockkey(self, state):
+
+        return("{}:refreshing".format(self.sessions.sessionkey(state)))
+
+    def store(self, state, accesstoken, refreshtoken, expiresin):
+        """
+            Save a user's tokens, with the time the access token expires, to
+            their session.
+        """
+        self.sessions.update(state, accesstoken=accesstoken,
+                             refreshtoken=refreshtoken,
+                             expiresat=time.time() + float(expiresin))
+
+    def accesstoken(self, state):
+        """
+            Get a user's access token, refreshing it first if it has less
+            than margin seconds left (or its expiry time isn't known).
+
+            Returns the access token, or None if there is no session for
+            state or the token has expired and can't be refreshed.
+        """
+        deadline = time.time() + self.locktimeout
+        while True:
+            user = self.sessions.get(state, "accesstoken", "refreshtoken",
+                                     "expiresat")
+            if user is None or not user["accesstoken"]:
+                return(None)
+            expiresat = float(user["expiresat"] or 0)
+            if expiresat - time.time() > self.margin:
+                return(user["accesstoken"])
+
+            if self.redis.set(self.lockkey(state), 1, nx=True,
+                              ex=self.locktimeout):
+                try:
+                    return(self.renew(state, user, expiresat))
+                finally:
+                    self.redis.delete(self.lockkey(state))
+
+            # another process is refreshing it
+            if time.time() > deadline:
+                return(self.stale(user, expiresat))
+            time.sleep(self.poll)
+
+    def renew(self, state, user, expiresat):
+        """
+            Refresh a user's access token, holding the lock, unless another
+            process did between reading the session and taking the lock.
+
+            Returns the access token, or None if it has expired and couldn't
+            be refreshed.
+        """
+        latest = self.sessions.get(state, "accesstoken", "expiresat")
+        if latest and float(latest["expiresat"] or 0) - time.time() > \
+                self.margin:
+            return(latest["accesstoken"])
+        if not user["refreshtoken"]:
+            return(self.stale(user, expiresat))
+
+        instruments.count("token_refreshes_total")
+        accesstoken, refreshtoken, expiresin = \
+            self.refresh(user["refreshtoken"])
+        if accesstoken is None:
+            instruments.count("token_refresh_failures_total")
+            return(self.stale(user, expiresat))
+        self.store(state, accesstoken, refreshtoken, expiresin)
+        return(accesstoken)
+
+    def stale(self, user, expiresat):
+        """
+            Returns the old access token if it hasn't quite expired yet, to
+            use when a refresh failed or took too long, or None.
+        """
+        if expiresat > time.time():
+            return(user["accesstoken"])
+        return(None)
@@ -1,86 +1,49 @@
 # Track class to represent a spotify track
 # Contains information about the track, like track id and audio features about
-# the track obtained from the /audio-features endpoint
-
-class Track():
-
-    def __init__(self):
-
-        self.trackid = None
-        self.trackname = None
-        self.artistname = None
-        self.albumname = None
-        self.popularity = None
-        self.danceability = None
-        self.energy = None
-        self.key = None
-        self.loudness = None
-        self.mode = None
-        self.speechiness = None
-        self.acousticness = None
-        self.instrumentalness = None
-        self.liveness = None
-        self.loudness = None
-        self.valence = None
-        self.tempo = None
-        self.duration_ms = None
-        self.time_signature = None
-        self.normalizedlist = None # a list of attribute values, normalized to
-                                   # float from[0.0, 1.0] for sensible 
-                                   # comparison
-        self.normtotal = None
+# the track obtained from the /audio-features endpoint. The values themselves
+# live in a TrackTable holding all of a playlist's tracks (see tracktable.py)
 
-    def createnormalizedlist(self):
+from tracktable import TrackTable, FEATURES, NUMBERS, STRINGS
 
-        # initialize list
-        self.normalizedlist = []
+class Track(object):
 
-        # list of weights to give each attribute
-        weights = [3, # danceability
-                   3, # energy
-                   1, # mode
-                   1, # speechiness
-                   2, # acousticness
-                   1, # instrumentalness
-                   1, # liveness
-                   0.1, # loudness
-                   5, # valence
-                   1, # tempo
-                    ]
+    # a Track is a view of row "index" of a TrackTable; every attribute below
+    # (trackid, danceability, ...) reads and writes that row
+    __slots__ = ("table", "index")
 
-        # danceability [0,1] ; 1 more danceable
-        self.normalizedlist.append(self.danceability * weights[0])
+    def __init__(self, table=None, index=None):
 
-        # energy [0,1] ; 1 more energetic
-        self.normalizedlist.append(self.danceability * weights[1])
+        # a track made on its own gets a one row table
+        if table is None:
+            table = TrackTable()
+            index = table.append()
+        self.table = table
+        self.index = index
 
-        # mode 0 or 1. 0 minor 1 major
-        self.normalizedlist.append(self.mode * weights[2])
+    def __getstate__(self):
 
-        # speechiness [0,1] 1 more speechy
-        self.normalizedlist.append(self.speechiness * weights[3])
+        return((self.table, self.index))
 
-        # acousticness [0,1] 1 more acoustic
-        self.normalizedlist.append(self.acousticness * weights[4])
+    def __setstate__(self, state):
 
-        # instrumentalness [0,1] 1 more instrumental
-        self.normalizedlist.append(self.instrumentalness * weights[5])
+        self.table, self.index = state
 
-        # liveness [0,1] 1 more likely performed live
-        self.normalizedlist.append(self.liveness * weights[6])
+    def createnormalizedlist(self):
 
-        # loudness around [-60, 0], larger numbers louder
-        self.normalizedlist.append(((self.loudness + 60) / 60) * weights[7])
+        # the values for every track in the table are normalized at once
+        self.table.normalize()
 
-        # valence [0,1] 1 sounds more positive
-        self.normalizedlist.append(self.valence * weights[8])
+    @property
+    def normalizedlist(self):
+        # a list of attribute values, normalized to float from[0.0, 1.0] for
+        # sensible comparison, then weighted
 
-        # tempo, most probably in range of 60 - 180 or so
-        self.normalizedlist.append(self.tempo / 180 * weights[9])
+        return(self.table.normalize()[self.index].tolist())
 
-        # add total sum
-        self.normtotal = sum(self.normalizedlist)
+    @property
+    def normtotal(self):
 
+        return(sum(self.normalizedlist))
 
     def __str__(self):
 
@@ -126,3 +89,18 @@ class Track():
                 time_signature=self.time_signature
             )
         )
+
+
+def column(name):
+    """
+        Returns a property that reads and writes column "name" of a track's
+        row in its table.
+    """
+    return(property(lambda self: self.table.getvalue(name, self.index),
+                    lambda self, value: self.table.setvalue(name, self.index,
+                                                            value)))
+
+for name in STRINGS:
+    setattr(Track, name, column(name))
+for name, dtype in FEATURES + NUMBERS:
+    setattr(Track, name, column(name))
@@ -0,0 +1,214 @@
+# TrackTable class to hold all of a playlist's tracks column by column
+# Each audio feature is one typed numpy array with an entry per track, and
+# ids and names are plain lists of strings, rather than one object with its
+# own __dict__ per track. Track objects (see track.py) are lightweight views
+# of one row of a table. The weighted, normalized attribute values used by
+# the flow algorithms are kept as one matrix with a row per track for each
+# FlowProfile used (see normalize).
+
+import numpy as np
+
+from flowprofiles import ATTRIBUTES, getprofile
+
+# columns filled from the /audio-features endpoint, with the type of each
+FEATURES = [("danceability", np.float64),
+            ("energy", np.float64),
+            ("key", np.int32),
+            ("loudness", np.float64),
+            ("mode", np.int32),
+            ("speechiness", np.float64),
+            ("acousticness", np.float64),
+            ("instrumentalness", np.float64),
+            ("liveness", np.float64),
+            ("valence", np.float64),
+            ("tempo", np.float64),
+            ("duration_ms", np.int32),
+            ("time_signature", np.int32),
+            ]
+
+# other numeric columns, filled from the playlist's track listing
+NUMBERS = [("popularity", np.int32)]
+
+# string columns
+STRINGS = ["trackid", "trackname", "artistname", "albumname"]
+
+# stands in for None in integer columns (floats use NaN)
+MISSING = np.iinfo(np.int32).min
+
+class TrackTable():
+
+    def __init__(self, capacity=0):
+
+        self.size = 0 # number of tracks in the table
+        self.capacity = capacity # number of rows allocated in each column
+        self.numbers = {} # numeric column name -> array
+        for name, dtype in FEATURES + NUMBERS:
+            self.numbers[name] = self.emptycolumn(dtype, capacity)
+        self.strings = {} # string column name -> list
+        for name in STRINGS:
+            self.strings[name] = []
+        self.scaledmatrix = None # attribute matrix, see scaled
+        self.normalized = {} # profile key -> normalized matrix, see normalize
+
+    def __len__(self):
+
+        return(self.size)
+
+    def emptycolumn(self, dtype, length):
+
+        if dtype == np.float64:
+            return(np.full(length, np.nan))
+        return(np.full(length, MISSING, dtype=dtype))
+
+    def append(self, **values):
+        """
+            Add a track to the end of the table, with any column values given
+            as keyword arguments.
+
+            Returns the index of the new row.
+        """
+        if self.size == self.capacity:
+            self.grow(max(2 * self.capacity, 16))
+
+        index = self.size
+        self.size = self.size + 1
+        for name in STRINGS:
+            self.strings[name].append(None)
+        for name, value in values.items():
+            self.setvalue(name, index, value)
+        return(index)
+
+    def appendcolumns(self, count, **columns):
+        """
+            Add "count" tracks to the end of the table at once, with whole
+            columns of values (arrays or lists of length count) given as
+            keyword arguments.
+
+            Returns the index of the first new row.
+        """
+        if self.size + count > self.capacity:
+            self.grow(max(2 * self.capacity, self.size + count))
+
+        start = self.size
+        self.size = self.size + count
+        for name in STRINGS:
+            values = columns.get(name)
+            if values is None:
+                values = [None] * count
+            self.strings[name].extend(values)
+        for name, values in columns.items():
+            if name not in self.strings:
+                self.numbers[name][start:self.size] = values
+        self.scaledmatrix = None
+        self.normalized = {}
+        return(start)
+
+    def grow(self, capacity):
+        """
+            Make room for "capacity" rows in every numeric column.
+        """
+        for name, dtype in FEATURES + NUMBERS:
+            column = self.emptycolumn(dtype, capacity)
+            column[:self.size] = self.numbers[name][:self.size]
+            self.numbers[name] = column
+        self.capacity = capacity
+
+    def getvalue(self, name, index):
+        """
+            Returns the value of column "name" for row "index", or None if it
+            hasn't been set.
+        """
+        if name in self.strings:
+            return(self.strings[name][index])
+        value = self.numbers[name][index]
+        if value == MISSING or value != value: # NaN is not equal to itself
+            return(None)
+        return(value.item())
+
+    def setvalue(self, name, index, value):
+
+        if name in self.strings:
+            self.strings[name][index] = value
+            return
+        if value is None:
+            value = MISSING if self.numbers[name].dtype != np.float64 else np.nan
+        self.numbers[name][index] = value
+        self.scaledmatrix = None
+        self.normalized = {}
+
+    def setfeatures(self, index, features):
+        """
+            Fill in the audio feature columns of row "index" from one entry of
+            the /audio-features response.
+        """
+        for name, dtype in FEATURES:
+            self.setvalue(name, index, features[name])
+
+    def column(self, name):
+        """
+            Returns the filled part of numeric column "name" (not a copy).
+        """
+        return(self.numbers[name][:self.size])
+
+    def floatcolumn(self, name):
+        """
+            Returns the filled part of numeric column "name" as floats, with
+            NaN where no value has been set.
+        """
+        column = self.column(name)
+        if column.dtype == np.float64:
+            return(column)
+        return(np.where(column == MISSING, np.nan, column))
+
+    def scaled(self):
+        """
+            Build the matrix of the attributes the flows compare, for every
+            track at once, each scaled to about [0, 1] over its usual range
+            but not yet weighted. Kept until any numeric value changes.
+
+            Returns the (n, len(ATTRIBUTES)) matrix, with columns in the
+            order of ATTRIBUTES.
+        """
+        if self.scaledmatrix is not None:
+            return(self.scaledmatrix)
+
+        c = self.floatcolumn
+        self.scaledmatrix = np.column_stack([
+            # danceability [0,1] ; 1 more danceable
+            c("danceability"),
+            # energy [0,1] ; 1 more energetic
+            c("energy"),
+            # mode 0 or 1. 0 minor 1 major
+            c("mode"),
+            # speechiness [0,1] 1 more speechy
+            c("speechiness"),
+            # acousticness [0,1] 1 more acoustic
+            c("acousticness"),
+            # instrumentalness [0,1] 1 more instrumental
+            c("instrumentalness"),
+            # liveness [0,1] 1 more likely performed live
+            c("liveness"),
+            # loudness around [-60, 0], larger numbers louder
+            (c("loudness") + 60) / 60,
+            # valence [0,1] 1 sounds more positive
+            c("valence"),
+            # tempo, most probably in range of 60 - 180 or so
+            c("tempo") / 180,
+        ])
+        return(self.scaledmatrix)
+
+    def normalize(self, profile=None):
+        """
+            Build the normalized attribute matrix for every track at once, a
+            row per track, by applying a FlowProfile (or anything getprofile
+            takes; the default profile if None) to the scaled matrix. For the
+            default profile the rows are what track.normalizedlist gives.
+            Kept for each profile until any numeric value changes.
+
+            Returns the (n, len(ATTRIBUTES)) matrix.
+        """
+        profile = getprofile(profile)
+        key = profile.key()
+        if key not in self.normalized:
+            self.normalized[key] = profile.apply(self.scaled())
+        return(self.normalized[key])
@@ -0,0 +1,225 @@
+# Worker process for the jobs the web process enqueues (see jobs.py)
+# "flow" jobs run the whole /selection pipeline for a playlist: get its
+# tracks and their audio features, sort them with a flow algorithm and write
+# the new playlist to spotify. "playlists" jobs fill in the rest of a user's
+# list of playlists after /callback has shown the first page. Run as many
+# worker processes as needed, separately from the web processes (the
+# "worker" entry in the Procfile).
+
+import json
+import os
+import timeit
+
+import redis
+
+import clplaylistflow as pf
+import metrics
+import profiling
+import sort
+from featurecache import FeatureCache
+from flowcache import FlowCache
+from instrument import instruments
+from jobs import JobQueue, JobFailed
+from sessionstore import SessionStore
+from tokens import TokenManager
+from flowprofiles import getprofile
+
+r = redis.from_url(os.environ.get("REDIS_URL"))
+featurecache = FeatureCache(r,
+    maxentries=int(os.environ.get("FEATURECACHE_SIZE", 500000)))
+flowcache = FlowCache(r,
+    maxentries=int(os.environ.get("FLOWCACHE_SIZE", 5000)),
+    bypass=os.environ.get("FLOWCACHE_BYPASS") == "1")
+sessions = SessionStore(r)
+jobqueue = JobQueue(r)
+tokens = TokenManager(sessions, pf.refreshtokens)
+instruments.connect(r)
+
+# arguments to sortbyflow (besides the flow, the flow profile and the
+# refinement time), which together with them decide the result
+FLOWPARAMS = {"size": 50, "refine": True}
+
+# seconds of refinement per track, and the least and most it gets. Refining
+# until nothing improves takes about 0.2s for 1000 tracks, 3s for 5000, 20s
+# for 20000 and 75s for 50000, and most of the gain comes in the first half,
+# so a fixed 2 seconds was plenty for small playlists and did next to
+# nothing for large ones
+REFINEPERTRACK = float(os.environ.get("REFINEPERTRACK", 0.0005))
+REFINEMIN = float(os.environ.get("REFINEMIN", 1))
+REFINEMAX = float(os.environ.get("REFINEMAX", 30))
+
+# set FLOWMETRICS=1 to log the flow metrics (see metrics.py) of each playlist
+# sorted, next to those of a single nearest neighbor path over the whole
+# playlist (what fullnnflow finds) for playlists up to FLOWMETRICS_REFERENCE
+# tracks
+FLOWMETRICS = os.environ.get("FLOWMETRICS") == "1"
+FLOWMETRICS_REFERENCE = int(os.environ.get("FLOWMETRICS_REFERENCE", 2000))
+
+def flowjob(payload):
+    """
+        Make a flowed copy of one of a user's playlists. The payload holds the
+        user's "state", the name of the playlist ("choice") and the "flow"
+        algorithm to use, and optionally the "flowprofile" (a dict of
+        FlowProfile arguments) to use it with. If the playlist has been flowed the same way
+        before, the result is taken from the flow cache, with nothing more
+        fetched from spotify if the playlist hasn't changed since; "nocache"
+        in the payload skips looking there.
+
+        Returns a dict with the "name" and "url" of the new playlist.
+    """
+    state = payload["state"]
+
+    # get the user's id and a token with enough time left for the whole job
+    user = sessions.get(state, "userid")
+    accesstoken = tokens.accesstoken(state)
+    if user is None or not accesstoken:
+        raise JobFailed("Your session has expired. Please log in again.",
+                        retry=False)
+
+    chosenplaylist = sessions.getplaylist(state, payload["choice"])
+    if chosenplaylist is None:
+        raise JobFailed("No playlist named {}".format(payload["choice"]),
+                        retry=False)
+
+    flow = payload.get("flow", "fastnn")
+    try:
+        profile = getprofile(payload.get("flowprofile"))
+    except (TypeError, ValueError) as e:
+        raise JobFailed("Unknown flow profile: {}".format(e), retry=False)
+    params = dict(FLOWPARAMS, profile=profile.params(),
+                  refinebudget=[REFINEPERTRACK, REFINEMIN, REFINEMAX])
+    usecache = not payload.get("nocache")
+
+    # an unchanged playlist that's been flowed before needs nothing fetched
+    newtracklist = None
+    if usecache:
+        newtracklist = flowcache.getsnapshot(chosenplaylist.playlistid,
+                                             chosenplaylist.snapshotid, flow,
+                                             params)
+    profiling.note(playlist=chosenplaylist.playlistid,
+                   cached="snapshot" if newtracklist is not None else None)
+
+    if newtracklist is None:
+        # get list of the playlist's tracks and the info for each of them,
+        # fetched together
+        playlist = pf.getplaylistinfo(accesstoken, chosenplaylist,
+                                      featurecache)
+        if playlist is None:
+            raise JobFailed("Couldn't get the playlist's songs from spotify.")
+
+        # double check to make sure playlist isn't empty
+        if not playlist.tracks:
+            raise JobFailed("Looks like the playlist you chose doesn't have any songs in it (or only has non-spotify songs in it). Try a different one!",
+                            retry=False)
+
+        trackids = [track.trackid for track in playlist.tracks]
+        profiling.note(tracks=len(trackids))
+        if usecache:
+            newtracklist = flowcache.get(trackids, flow, params)
+        if newtracklist is not None:
+            profiling.note(cached="result")
+            flowcache.setsnapshot(trackids, flow, params,
+                                  chosenplaylist.playlistid,
+                                  chosenplaylist.snapshotid)
+        else:
+            # run flow algorithm to determine correct order
+            newtracklist = pf.sortbyflow(playlist=playlist, flow=flow,
+                                         profile=profile,
+                                         refinetime=refinetime(len(trackids)),
+                                         **FLOWPARAMS)
+            if not newtracklist:
+                raise JobFailed("Sorting the playlist failed.", retry=False)
+            if FLOWMETRICS:
+                logmetrics(playlist, flow, newtracklist, profile)
+            flowcache.set(trackids, flow, params, newtracklist,
+                          chosenplaylist.playlistid, chosenplaylist.snapshotid)
+
+    # create new playlist with that track order. not retried, as a second
+    # try could leave two copies of the playlist
+    created = pf.createspotifyplaylist(accesstoken,
+                                       chosenplaylist.name,
+                                       set(sessions.playlistnames(state)),
+                                       newtracklist,
+                                       user["userid"])
+    if not created:
+        raise JobFailed("Couldn't create the new playlist on spotify.",
+                        retry=False)
+
+    playlistname, url = created
+    return({"name": playlistname, "url": url})
+
+def refinetime(tracks):
+    """
+        Returns the seconds to spend refining the order of a playlist of
+        "tracks" tracks: REFINEPERTRACK for each track, at least REFINEMIN
+        and at most REFINEMAX.
+    """
+    return(min(REFINEMAX, max(REFINEMIN, tracks * REFINEPERTRACK)))
+
+def logmetrics(playlist, flow, newtracklist, profile=None):
+    """
+        Print the flow metrics of a playlist sorted by flow (with profile)
+        into the order of newtracklist, and of the reference nearest neighbor path if the
+        playlist is small enough, as a line of JSON.
+    """
+    # the sorted list is of URIs, so match them back up with the tracks
+    tracks = {}
+    for track in playlist.tracks:
+        tracks.setdefault(track.trackid, []).append(track)
+    ordered = [tracks[uri.split(":")[-1]].pop() for uri in newtracklist]
+
+    line = {"flow": flow, "playlist": playlist.playlistid,
+            "metrics": metrics.flowmetrics(ordered, profile)}
+    if len(playlist.tracks) <= FLOWMETRICS_REFERENCE:
+        line["reference"] = metrics.flowmetrics(
+            sort.vectornnflow(playlist, profile), profile)
+    print("flowmetrics {}".format(json.dumps(line, sort_keys=True)))
+
+def playlistsjob(payload):
+    """
+        Add all of a user's playlists to their session, a page at a time as
+        they arrive, then mark the list complete. The payload holds the
+        user's "state".
+
+        Returns an empty dict.
+    """
+    state = payload["state"]
+
+    accesstoken = tokens.accesstoken(state)
+    if not accesstoken:
+        raise JobFailed("Your session has expired. Please log in again.",
+                        retry=False)
+
+    for response in pf.iterpages(pf.PLAYLISTSURL, accesstoken,
+                                 pf.PLAYLISTPAGESIZE):
+        if response is None:
+            raise JobFailed("Couldn't get the playlists from spotify.")
+        playlists = [pf.playlistfromitem(item) for item in response["items"]]
+        sessions.addplaylists(state, playlists, response["offset"])
+
+    sessions.update(state, playlisttotal=response["total"],
+                    playlistscomplete=1)
+    return({})
+
+# job handlers by the "type" in the payload
+HANDLERS = {"flow": flowjob, "playlists": playlistsjob}
+
+def handle(payload):
+
+    jobtype = payload.get("type", "flow")
+    start = timeit.default_timer()
+    try:
+        with profiling.profiled(profiling.sampled(payload), type=jobtype,
+                                flow=payload.get("flow")):
+            return(HANDLERS[jobtype](payload))
+    finally:
+        instruments.observe("job_seconds", timeit.default_timer() - start,
+                            type=jobtype)
+        instruments.flush()
+
+def main():
+
+    jobqueue.work(handle)
+
+if __name__ == "__main__":
+    main()